@@ -0,0 +1,194 @@
+# CS472 - Homework #4
+# Edward Parrish
+# acceptor.py
+#
+# This module is the acceptor module of the FTP server. It contains the
+# Acceptor class which the major module uses to accept clients on every
+# Passive Mode listening socket from a single thread.
+
+import selectors
+import socket
+import threading
+import time
+import traceback
+
+
+class Acceptor:
+    '''Acceptor
+    A single thread that waits on many listening sockets with a selector. When
+    a client connects to a listening socket it is accepted and handed to the
+    socket's callback; if no client connects before the socket's timeout the
+    socket is closed and its timeout callback is called instead. Listening
+    sockets are only ever closed by the acceptor's thread so a socket is never
+    closed while it is still registered with the selector.'''
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.requests = []
+        self.deadlines = {}
+
+        # Writing to the wake socket interrupts the thread's select().
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+        self.thread = threading.Thread(
+            target=self.run, name='acceptor', daemon=True)
+        self.thread.start()
+
+    def add(self, listener, on_accept, on_timeout, timeout):
+        '''add(listener, on_accept, on_timeout, timeout)
+        Wait for a client to connect to listener. on_accept(conn, addr) is
+        called with the accepted client, or on_timeout() is called if no client
+        connects within timeout seconds.'''
+
+        self.request(('add', listener, on_accept, on_timeout, timeout))
+
+    def remove(self, listener):
+        '''remove(listener)
+        Stop waiting on listener and close it.'''
+
+        self.request(('remove', listener))
+
+    def request(self, req):
+        '''request(req)
+        Queue a request for the acceptor's thread and wake it.'''
+
+        with self.lock:
+            self.requests.append(req)
+
+        try:
+            self.wake_w.send(b'\0')
+        except BlockingIOError:
+            # The thread already has a wake-up pending.
+            pass
+
+    def pending(self):
+        '''pending() -> number of listening sockets being waited on'''
+
+        return len(self.deadlines)
+
+    def run(self):
+        '''run()
+        The main loop of the acceptor's thread. Each listening socket and
+        request is handled with call(), so one that fails is logged and does
+        not stop the thread, which would leave Passive Mode unusable.'''
+
+        while True:
+            for key, events in self.selector.select(self.next_timeout()):
+                if key.fileobj is self.wake_r:
+                    self.drain_wake()
+                else:
+                    self.call(self.accept, key.fileobj, key.data)
+
+            self.handle_requests()
+            self.expire()
+
+    def next_timeout(self):
+        '''next_timeout() -> seconds until the next deadline or None'''
+
+        if not self.deadlines:
+            return None
+
+        return max(0, min(self.deadlines.values()) - time.monotonic())
+
+    def drain_wake(self):
+        '''drain_wake()
+        Read all pending wake-up bytes.'''
+
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def handle_requests(self):
+        '''handle_requests()
+        Register and remove listening sockets as requested by other threads.'''
+
+        with self.lock:
+            requests = self.requests
+            self.requests = []
+
+        for req in requests:
+            self.call(self.handle_request, req)
+
+    def handle_request(self, req):
+        '''handle_request(req)
+        Register or remove a listening socket.'''
+
+        if req[0] == 'add':
+            op, listener, on_accept, on_timeout, timeout = req
+            listener.setblocking(False)
+            self.selector.register(
+                listener, selectors.EVENT_READ, (on_accept, on_timeout))
+            self.deadlines[listener] = time.monotonic() + timeout
+
+        else:
+            self.close(req[1])
+
+    def accept(self, listener, callbacks):
+        '''accept(listener, callbacks)
+        Accept a client on a readable listening socket and hand it to the
+        socket's accept callback, or call its timeout callback if the accept
+        failed.'''
+
+        try:
+            conn, addr = listener.accept()
+        except BlockingIOError:
+            return
+        except OSError:
+            conn = None
+
+        self.close(listener)
+
+        # Test if accept failed; wake the waiter instead of leaving it to
+        # wait for a client that can no longer connect.
+        if not conn:
+            self.call(callbacks[1])
+            return
+
+        # Data transfers are done with blocking sockets.
+        conn.setblocking(True)
+        self.call(callbacks[0], conn, addr)
+
+    def expire(self):
+        '''expire()
+        Close every listening socket whose deadline has passed and call its
+        timeout callback.'''
+
+        now = time.monotonic()
+        expired = [l for l, d in self.deadlines.items() if d <= now]
+        for listener in expired:
+            self.call(self.expire_listener, listener)
+
+    def expire_listener(self, listener):
+        '''expire_listener(listener)
+        Close a listening socket whose deadline has passed and call its timeout
+        callback.'''
+
+        callbacks = self.selector.get_key(listener).data
+        self.close(listener)
+        self.call(callbacks[1])
+
+    def call(self, callback, *args):
+        '''call(callback, *args)
+        Call a callback, or one of the acceptor's own handlers; a failing one
+        must not stop the acceptor.'''
+
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def close(self, listener):
+        '''close(listener)
+        Unregister and close a listening socket.'''
+
+        # Test if listener is still registered.
+        if self.deadlines.pop(listener, None) is not None:
+            self.selector.unregister(listener)
+
+        listener.close()
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+# CS472 - Homework #4
+# Edward Parrish
+# bench.py
+#
+# This module is the benchmark of the FTP server. It starts the server on
+# loopback, drives many concurrent simulated clients through it, and writes
+# the results as JSON so that releases can be compared.
+#
+# Usage:
+#     python3 bench.py [--clients N] [--rounds N] [--engine thread|async]
+#                      [--sizes 1K,1M,100M] [--dirs 10,1000,10000]
+#                      [--set option=value ...] [--label LABEL]
+#                      [--output FILE]
+
+import argparse
+import contextlib
+import ftplib
+import json
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+USER = 'cs472'
+PASSWORD = 'hw2ftp'
+DATA_MODES = ['PASV', 'EPSV', 'PORT', 'EPRT']
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+# Files no larger than this are transferred every round, larger files once.
+SMALL_FILE = 1 << 20
+
+
+class Stats:
+    '''Stats
+    Thread safe collection of the latency of every command the simulated
+    clients send, and of the number of operations that failed.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = 0
+
+    def latency(self, verb, seconds):
+        '''latency(verb, seconds)
+        Record the time taken to get the reply to a command.'''
+
+        with self.lock:
+            self.latencies.setdefault(verb, []).append(seconds)
+
+    def error(self):
+        '''error()
+        Count a failed operation.'''
+
+        with self.lock:
+            self.errors += 1
+
+    def percentiles(self):
+        '''percentiles() -> dictionary of command to latency in milliseconds'''
+
+        result = {}
+        with self.lock:
+            for verb, samples in sorted(self.latencies.items()):
+                samples = sorted(samples)
+                n = len(samples)
+                result[verb] = {'count': n}
+                for q in (50, 95, 99):
+                    i = min(n - 1, n * q // 100)
+                    result[verb][f'p{q}'] = round(samples[i] * 1000, 3)
+
+                result[verb]['max'] = round(samples[-1] * 1000, 3)
+
+        return result
+
+
+class BenchClient(ftplib.FTP):
+    '''BenchClient
+    An FTP client that times every command it sends, and opens its data
+    connections with the chosen command: PASV, EPSV, PORT, or EPRT.'''
+
+    def __init__(self, stats, data_mode='PASV'):
+        super().__init__(timeout=60)
+        self.stats = stats
+        self.data_mode = data_mode
+        self.set_pasv(data_mode in ('PASV', 'EPSV'))
+
+    def timed(self, send, cmd):
+        '''timed(send, cmd) -> reply
+        Send a command with send and record how long the reply took.'''
+
+        start = time.perf_counter()
+        try:
+            return send(cmd)
+        finally:
+            verb = cmd.split(' ', 1)[0].upper()
+            self.stats.latency(verb, time.perf_counter() - start)
+
+    def sendcmd(self, cmd):
+        return self.timed(super().sendcmd, cmd)
+
+    def voidcmd(self, cmd):
+        return self.timed(super().voidcmd, cmd)
+
+    def makepasv(self):
+        '''makepasv() -> (host, port)
+        Enter Passive Mode with PASV or EPSV.'''
+
+        # Test if Extended Passive Mode.
+        if self.data_mode == 'EPSV':
+            return ftplib.parse229(self.sendcmd('EPSV'), self.sock.getpeername())
+
+        untrusted_host, port = ftplib.parse227(self.sendcmd('PASV'))
+        return self.sock.getpeername()[0], port
+
+    def makeport(self):
+        '''makeport() -> listening socket
+        Listen for the server's data connection and send PORT or EPRT.'''
+
+        sock = socket.create_server(('', 0), backlog=1)
+        host = self.sock.getsockname()[0]
+        port = sock.getsockname()[1]
+
+        # Test if Extended Port Mode.
+        if self.data_mode == 'EPRT':
+            self.sendeprt(host, port)
+        else:
+            self.sendport(host, port)
+
+        sock.settimeout(self.timeout)
+        return sock
+
+
+class Zeros:
+    '''Zeros
+    A file like object of size zero bytes, so files of any size can be
+    uploaded without being held in memory or on disk.'''
+
+    def __init__(self, size):
+        self.left = size
+        self.chunk = bytes(1 << 16)
+
+    def read(self, n):
+        n = min(n, self.left, len(self.chunk))
+        self.left -= n
+        return self.chunk[:n]
+
+
+def parse_size(text):
+    '''parse_size(text) -> number of bytes
+    Parse a size such as 512, 1K, 10M, or 2G.'''
+
+    text = text.strip().upper()
+
+    # Test if size has a unit.
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+
+    return int(text)
+
+
+def free_port():
+    '''free_port() -> number of a free loopback port'''
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def prepare(root, sizes, dirs):
+    '''prepare(root, sizes, dirs)
+    Create the files the clients download and the directories they list in
+    the benchmark user's home directory. Files are created sparse, so even
+    multi-gigabyte files are created instantly.'''
+
+    home = os.path.join(root, 'home', USER)
+    os.makedirs(os.path.join(root, 'home', 'elp49'), exist_ok=True)
+    os.makedirs(home, exist_ok=True)
+
+    for size in sizes:
+        with open(os.path.join(home, f'file_{size}'), 'wb') as f:
+            f.truncate(size)
+
+    for n in dirs:
+        path = os.path.join(home, f'dir_{n}')
+        os.makedirs(path, exist_ok=True)
+        for i in range(n):
+            open(os.path.join(path, f'entry_{i:07d}'), 'wb').close()
+
+
+def serve(port, engine, settings):
+    '''serve(port, engine, settings)
+    Run the FTP server in this process until it is interrupted. Used by the
+    benchmark to start the server as a child process.'''
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ftpserver
+    from util import Config, File
+
+    config = Config()
+    config.port_mode = True
+    for setting in settings:
+        attribute, value = setting.split('=', 1)
+        config.set_attribute(attribute, value)
+
+    config.async_mode = engine == 'async'
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if config.async_mode:
+        ftpserver.server = ftpserver.AsyncServer('bench.log', port, config)
+    else:
+        ftpserver.server = ftpserver.Server('bench.log', port, config)
+
+    # Test if files are kept in memory; copy the benchmark files there.
+    if config.memory_storage:
+        File.STORAGE.load(os.path.join(os.getcwd(), 'home'), '/home')
+
+    ftpserver.server.start()
+
+
+@contextlib.contextmanager
+def server_process(root, port, args):
+    '''server_process(root, port, args)
+    Start the server as a child process working in root and wait until it
+    accepts connections. The server is interrupted when the block ends.'''
+
+    cmd = [sys.executable, os.path.abspath(__file__), '--serve', str(port),
+           '--engine', args.engine]
+    for setting in args.set:
+        cmd += ['--set', setting]
+
+    proc = subprocess.Popen(cmd, cwd=root)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except OSError:
+                # Test if server failed to start.
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError('server did not start')
+
+                time.sleep(0.05)
+
+        yield proc
+
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+@contextlib.contextmanager
+def session(port, stats, data_mode='PASV'):
+    '''session(port, stats, data_mode='PASV') -> logged in client'''
+
+    f = BenchClient(stats, data_mode)
+    f.connect('127.0.0.1', port)
+    try:
+        f.login(USER, PASSWORD)
+        yield f
+        f.quit()
+    finally:
+        f.close()
+
+
+def run_clients(n, work, stats):
+    '''run_clients(n, work, stats) -> seconds taken
+    Run work(i) for each of n clients at once, each in its own thread, and
+    return the time until all of them finished. A client whose work fails is
+    counted as an error.'''
+
+    barrier = threading.Barrier(n + 1)
+
+    def client(i):
+        barrier.wait()
+        try:
+            work(i)
+        except (*ftplib.all_errors, EOFError):
+            stats.error()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+
+    return time.perf_counter() - start
+
+
+def bench_sessions(port, args, stats):
+    '''bench_sessions(port, args, stats) -> results
+    Each client connects, logs in, and quits once per round.'''
+
+    def work(i):
+        for r in range(args.rounds):
+            with session(port, stats):
+                pass
+
+    seconds = run_clients(args.clients, work, stats)
+    count = args.clients * args.rounds
+    return {'count': count, 'seconds': round(seconds, 3),
+            'per_second': round(count / seconds, 1)}
+
+
+def bench_data_modes(port, args, stats):
+    '''bench_data_modes(port, args, stats) -> results
+    Each client opens a data connection with each of PASV, EPSV, PORT, and
+    EPRT once per round and lists a small directory over it.'''
+
+    results = {}
+    for mode in DATA_MODES:
+        def work(i):
+            with session(port, stats, mode) as f:
+                for r in range(args.rounds):
+                    f.nlst()
+
+        seconds = run_clients(args.clients, work, stats)
+        count = args.clients * args.rounds
+        results[mode] = {'count': count, 'seconds': round(seconds, 3),
+                         'per_second': round(count / seconds, 1)}
+
+    return results
+
+
+def bench_listings(port, args, stats):
+    '''bench_listings(port, args, stats) -> results
+    Each client lists each benchmark directory once per round.'''
+
+    results = {}
+    for n in args.dirs:
+        def work(i):
+            with session(port, stats) as f:
+                for r in range(args.rounds):
+                    f.retrlines(f'LIST dir_{n}', lambda line: None)
+
+        seconds = run_clients(args.clients, work, stats)
+        count = args.clients * args.rounds
+        results[str(n)] = {'count': count, 'seconds': round(seconds, 3),
+                           'per_second': round(count / seconds, 1)}
+
+    return results
+
+
+def bench_transfers(port, args, stats):
+    '''bench_transfers(port, args, stats) -> results
+    Each client downloads and then uploads a file of each benchmark size,
+    every round for small files and once for large ones.'''
+
+    results = {}
+    for size in args.sizes:
+        rounds = args.rounds if size <= SMALL_FILE else 1
+
+        def retr(i):
+            with session(port, stats) as f:
+                for r in range(rounds):
+                    f.retrbinary(f'RETR file_{size}', lambda data: None,
+                                 blocksize=1 << 16)
+
+        def stor(i):
+            with session(port, stats) as f:
+                for r in range(rounds):
+                    f.storbinary(f'STOR upload_{i}_{size}', Zeros(size),
+                                 blocksize=1 << 16)
+
+        for command, work in (('RETR', retr), ('STOR', stor)):
+            seconds = run_clients(args.clients, work, stats)
+            nbytes = args.clients * rounds * size
+            results[f'{command} {size}'] = {
+                'count': args.clients * rounds, 'bytes': nbytes,
+                'seconds': round(seconds, 3),
+                'mb_per_second': round(nbytes / seconds / (1 << 20), 1)}
+
+    return results
+
+
+def bench(args):
+    '''bench(args) -> results
+    Run every benchmark against a new server and return the results.'''
+
+    stats = Stats()
+    results = {
+        'label': args.label,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': args.engine,
+        'clients': args.clients,
+        'rounds': args.rounds,
+        'settings': args.set,
+    }
+
+    with tempfile.TemporaryDirectory(prefix='ftpbench') as root:
+        prepare(root, args.sizes, args.dirs)
+        port = free_port()
+        with server_process(root, port, args):
+            results['sessions'] = bench_sessions(port, args, stats)
+            results['data_modes'] = bench_data_modes(port, args, stats)
+            results['listings'] = bench_listings(port, args, stats)
+            results['transfers'] = bench_transfers(port, args, stats)
+
+    results['latency_ms'] = stats.percentiles()
+    results['errors'] = stats.errors
+
+    # Peak resident set sizes in KiB of the server and of the clients.
+    results['peak_rss_kb'] = {
+        'server': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'clients': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+    return results
+
+
+def parse_args():
+    '''parse_args() -> parsed command line arguments'''
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the FTP server over loopback.')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='number of concurrent clients (default 8)')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='operations per client per benchmark (default 20)')
+    parser.add_argument('--engine', choices=['thread', 'async'],
+                        default='thread', help='server engine (default thread)')
+    parser.add_argument('--sizes', default='1K,1M,100M',
+                        help='sizes of the transferred files (default 1K,1M,100M)')
+    parser.add_argument('--dirs', default='10,1000,10000',
+                        help='entries in the listed directories '
+                             '(default 10,1000,10000)')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='OPTION=VALUE',
+                        help='server config option, may be repeated')
+    parser.add_argument('--label', default='',
+                        help='name of this run, such as a release')
+    parser.add_argument('--output', default='bench.json',
+                        help='file the JSON results are written to '
+                             '(default bench.json, - for stdout)')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    args.sizes = [parse_size(s) for s in args.sizes.split(',') if s]
+    args.dirs = [int(n) for n in args.dirs.split(',') if n]
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Test if started by the benchmark as the server process.
+    if args.serve:
+        try:
+            serve(args.serve, args.engine, args.set)
+        except KeyboardInterrupt:
+            pass
+
+    else:
+        results = bench(args)
+        text = json.dumps(results, indent=2)
+
+        if args.output == '-':
+            print(text)
+        else:
+            with open(args.output, 'w') as f:
+                f.write(text + '\n')
+
+            print(f'Results written to {args.output}.')
@@ -0,0 +1,326 @@
+# CS472 - Homework #4
+# Edward Parrish
+# cache.py
+#
+# This module is the cache module of the FTP server. It contains the caches
+# the major module uses to avoid redoing work for clients that repeatedly ask
+# for the same thing.
+
+import collections
+import contextlib
+import os
+import threading
+import time
+
+
+class ByteLRU:
+    '''ByteLRU
+    A thread safe least recently used cache bounded by the total size in bytes
+    of its values. Each entry is stored with a validator and is only returned
+    by get() while the caller's validator is equal to it, so a stale entry is
+    never served.'''
+
+    def __init__(self, budget, max_entry=None):
+        self.budget = budget
+        self.max_entry = max_entry if max_entry is not None else budget // 4
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, validator):
+        '''get(key, validator) -> cached value or None'''
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            # Test if entry is cached and still valid.
+            if entry and entry[0] == validator:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            # Test if entry is stale.
+            if entry:
+                self.remove(key)
+
+            self.misses += 1
+            return None
+
+    def put(self, key, validator, value):
+        '''put(key, validator, value) -> boolean
+        Cache value, evicting the least recently used entries to stay within
+        the budget. Returns False if value is too large to be cached.'''
+
+        n = len(value)
+        if n > self.max_entry:
+            return False
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+
+            self.entries[key] = (validator, value)
+            self.size += n
+
+            while self.size > self.budget:
+                old = next(iter(self.entries))
+                self.remove(old)
+                self.evictions += 1
+
+        return True
+
+    def invalidate(self, key):
+        '''invalidate(key)
+        Remove an entry if it is cached.'''
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+
+    def resize(self, budget):
+        '''resize(budget)
+        Change the budget, evicting the least recently used entries to stay
+        within it.'''
+
+        with self.lock:
+            self.budget = budget
+            self.max_entry = budget // 4
+            while self.size > self.budget:
+                old = next(iter(self.entries))
+                self.remove(old)
+                self.evictions += 1
+
+    def remove(self, key):
+        '''remove(key)
+        Remove an entry. The caller must hold the lock.'''
+
+        validator, value = self.entries.pop(key)
+        self.size -= len(value)
+
+    def counters(self):
+        '''counters() -> dictionary of counter name to value'''
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.size}
+
+
+class StatCache(ByteLRU):
+    '''StatCache
+    A ByteLRU of things read from paths. An entry is valid while the path's
+    inode, size, and modification time are unchanged, as reported by the stat
+    function of the storage the entries are read from.'''
+
+    def __init__(self, budget, stat=os.stat):
+        super().__init__(budget)
+        self.stat = stat
+
+    def validator(self, path):
+        '''validator(path) -> (inode, device, size, modification time) of path
+        or None if it cannot be read'''
+
+        try:
+            st = self.stat(path)
+        except OSError:
+            return None
+
+        return (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns)
+
+
+class ListingCache(StatCache):
+    '''ListingCache
+    A cache of rendered directory listings keyed by real path. Uploads change
+    the sizes shown in a listing without changing the directory, so they must
+    call invalidate_dir().'''
+
+    @staticmethod
+    def key(path, names_only):
+        '''key(path, names_only) -> cache key of a LIST or NLST of path'''
+
+        return (os.path.normpath(path), names_only)
+
+    def invalidate_dir(self, path):
+        '''invalidate_dir(path)
+        Remove the LIST and NLST listings of the directory at path.'''
+
+        self.invalidate(ListingCache.key(path, False))
+        self.invalidate(ListingCache.key(path, True))
+
+
+class FileCache(StatCache):
+    '''FileCache
+    A cache of the contents of small files keyed by real path, so a file that
+    many clients download is read once instead of once per download.'''
+
+
+class PathCache:
+    '''PathCache
+    A thread safe least recently used cache of path lookups, such as resolved
+    paths keyed by session directory and argument, or whether a path is a
+    readable directory. Entries expire ttl seconds after they were looked up,
+    so changes made outside the server are seen within ttl; changes the server
+    makes itself call invalidate(). A ttl of 0 turns the cache off.'''
+
+    def __init__(self, ttl, max_entries=8192):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key, compute):
+        '''lookup(key, compute) -> value
+        Return the cached value of key if it has not expired, otherwise call
+        compute() and cache its result.'''
+
+        # Test if cache is off.
+        if not self.ttl:
+            return compute()
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+
+            # Test if entry is cached and has not expired.
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = (now + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return value
+
+    def invalidate(self, keys):
+        '''invalidate(keys)
+        Remove the entries of keys that are cached.'''
+
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def counters(self):
+        '''counters() -> dictionary of counter name to value'''
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries)}
+
+
+class MapCache:
+    '''MapCache
+    Shares one read only memory map of a file between all the transfers of it
+    in flight, so concurrent downloads of a large file read the same pages. A
+    map is keyed by path and validator, so a file that has changed gets a new
+    map, and is closed when its last reader releases it. A file must not be
+    cut short while it is mapped, so writers call writing() first.'''
+
+    def __init__(self, open_map, close_map):
+        self.open_map = open_map
+        self.close_map = close_map
+        self.cond = threading.Condition()
+        self.maps = {}
+        self.writers = {}
+        self.opened = 0
+        self.shared = 0
+
+    def acquire(self, path, validator):
+        '''acquire(path, validator) -> map or None
+        Get the map of a file, mapping it if no transfer has it mapped. Returns
+        None if the file cannot be mapped or is being written.'''
+
+        key = (path, validator)
+        with self.cond:
+            # Test if file is being written.
+            if path in self.writers:
+                return None
+
+            entry = self.maps.get(key)
+            if entry:
+                entry[1] += 1
+                self.shared += 1
+                return entry[0]
+
+        m = self.open_map(path)
+        if m is None:
+            return None
+
+        with self.cond:
+            entry = self.maps.get(key)
+
+            # Test if another transfer mapped the file at the same time.
+            if entry:
+                entry[1] += 1
+                self.shared += 1
+            else:
+                entry = self.maps[key] = [m, 1]
+                self.opened += 1
+                m = None
+
+        if m is not None:
+            self.close_map(m)
+
+        return entry[0]
+
+    def release(self, path, validator):
+        '''release(path, validator)
+        Release a map got from acquire(), closing it if no transfer uses it.'''
+
+        key = (path, validator)
+        with self.cond:
+            entry = self.maps[key]
+            entry[1] -= 1
+
+            # Test if map is still in use.
+            if entry[1]:
+                return
+
+            del self.maps[key]
+            self.cond.notify_all()
+
+        self.close_map(entry[0])
+
+    @contextlib.contextmanager
+    def writing(self, path, timeout=None):
+        '''writing(path, timeout=None) -> boolean
+        Stop the file at path from being mapped and wait until no transfer
+        uses a map of it, so the file can be changed for the rest of the block
+        without a reader faulting on a page that was cut off. Yields False if
+        a transfer still uses a map of it after timeout seconds, in which case
+        the file must not be changed.'''
+
+        with self.cond:
+            self.writers[path] = self.writers.get(path, 0) + 1
+            ready = self.cond.wait_for(
+                lambda: all(p != path for p, v in self.maps), timeout)
+
+        try:
+            yield ready
+
+        finally:
+            with self.cond:
+                self.writers[path] -= 1
+                if not self.writers[path]:
+                    del self.writers[path]
+
+    def counters(self):
+        '''counters() -> dictionary of counter name to value'''
+
+        with self.cond:
+            return {'in_use': len(self.maps), 'opened': self.opened,
+                    'shared': self.shared}
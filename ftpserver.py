@@ -6,12 +6,33 @@
 # This module is the major module of the FTP server. It contains the main
 # processing loop that listens for and accepts new connections. Once a
 # connectionand has been accepts its control is handed off to a new thread to
-# allow multiple open each accepted connection.
+# allow multiple open each accepted connection. Alternatively, the AsyncServer
+# serves every control connection from a single asyncio event loop.
 
-from util import System, File
+from util import System, Config, ConfigWatcher, File
+from users import UserDB, Authenticator
 from logger import Logger
+from prefork import Supervisor
+from pool import WorkerPool
+from registry import Registry
+from cache import ListingCache, FileCache, MapCache, PathCache
+from ports import PortPool
+from storage import LocalStorage, MemoryStorage
+from acceptor import Acceptor
+from reaper import Reaper
+from shaping import Shaper, DOWNLOAD, UPLOAD
+from sockopts import SocketOptions, CONTROL, ACTIVE, PASSIVE, cork
+from metrics import Metrics, MetricsExporter
+from metrics import DURATION_BUCKETS, LATENCY_BUCKETS, RATE_BUCKETS
+from lines import LineBuffer, TOO_LONG
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import signal
 import socket
 import threading
+import time
+import zlib
 
 global server
 PORT_MIN = 1024
@@ -30,63 +51,380 @@ def log(description, client=None):
 
 
 def add_connection(client):
-    if client not in server.open_connections:
-        # Append client to list of open connections.
-        server.open_connections.append(client)
+    # Add client to registry of open connections.
+    server.open_connections.add_control(client)
 
 
 def remove_connection(client):
-    if client in server.open_connections:
-        # Remove client from list of open connections.
-        server.open_connections.remove(client)
+    # Remove client from registry of open connections.
+    server.open_connections.remove_control(client)
+
+
+def add_data_connection(data_conn):
+    # Add data connection to registry of open connections.
+    server.open_connections.add_data(data_conn)
+
+
+def remove_data_connection(data_conn):
+    # Remove data connection from registry of open connections.
+    server.open_connections.remove_data(data_conn)
+
+
+def open_log(filename, config):
+    '''open_log(filename, config) -> Logger
+    Create the logger of the log file with the configured flush and rotation
+    settings.'''
+
+    return Logger(
+        filename, flush_lines=config.log_flush_lines,
+        flush_interval=config.log_flush_ms / 1000,
+        max_bytes=config.log_max_bytes,
+        rotate_interval=config.log_rotate_seconds,
+        backups=config.log_backups, compress=config.log_compress)
+
+
+def configure_log(logger, config):
+    '''configure_log(logger, config)
+    Apply the configured flush and rotation settings to a running logger.'''
+
+    logger.flush_lines = config.log_flush_lines
+    logger.flush_interval = config.log_flush_ms / 1000
+    logger.max_bytes = config.log_max_bytes
+    logger.rotate_interval = config.log_rotate_seconds
+    logger.backups = config.log_backups
+    logger.compress = config.log_compress
+
+
+def create_server(filename, port, config, logger=None, reuse_port=False):
+    '''create_server(filename, port, config, logger=None, reuse_port=False)
+        -> server
+    Create the server of the configured engine as the module's server.'''
+
+    global server
+    if config.async_mode:
+        server = AsyncServer(filename, port, config, logger, reuse_port)
+    else:
+        server = Server(filename, port, config, logger, reuse_port)
+
+    return server
 
 
 class Server:
 
-    def __init__(self, filename, port, config):
-        self.logger = Logger(filename)
+    def __init__(self, filename, port, config, logger=None, reuse_port=False):
+        self.logger = logger or open_log(filename, config)
+        self.reuse_port = reuse_port
+
+        # The (index, number of workers) of a worker process, whose config
+        # is its share of the config file's settings.
+        self.partition = None
+        self.watcher = ConfigWatcher(self.reload)
         self.port = port
-        self.open_connections = []
+        self.open_connections = Registry()
         self.config = config
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.rejected = 0
+        self.pool = None
+        self.acceptor = None
+        File.use_storage(
+            MemoryStorage() if config.memory_storage else LocalStorage())
+        self.listings = ListingCache(config.listing_cache_bytes, File.stat)
+        self.maps = MapCache(File.map, File.unmap)
+        self.files = FileCache(Server.file_cache_bytes(config), File.stat)
+        File.use_path_cache(PathCache(config.path_cache_ms / 1000))
+        self.ports = PortPool(config.pasv_min_port, config.pasv_max_port)
+        self.auth = Authenticator(
+            UserDB(System.USERS_PATH, self.logger.write), config.auth_workers,
+            config.auth_cache_size, config.login_max_failures,
+            config.login_failure_window)
+        self.metrics = Metrics(gauges=self.counters)
+        self.shaper = Shaper(
+            config.download_rate, config.upload_rate,
+            config.user_download_rate, config.user_upload_rate,
+            self.throttled)
+        self.exporter = None
+        self.reaper = None
 
     def start(self):
         '''start()
         The main processing loop of the FTP server. Creates a socket to listen
-        for incomming connections. When a connection is accepted, starts a new
-        thread with target set to serve_client().'''
+        for incomming connections. When a connection is accepted, and the
+        server is not full, queues serve_client() on the worker pool.'''
+
+        self.pool = WorkerPool(self.config.worker_threads)
+        self.acceptor = Acceptor()
+        self.start_exporter()
+        self.start_reaper()
+        self.start_watcher()
 
         # Get Server family and test if it has dualstack IPv6.
         # fam, has_ds = self.server_params()
 
         # Create socket that will listen for client connections.
         # with socket.create_server(('', self.port), family=fam, dualstack_ipv6=has_ds) as sock:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            # Bind socket.
-            sock.bind(('', port))
-            log(f'Binding to address: localhost:{self.port}.')
-
-            sock.listen()
+        with self.listen() as sock:
             while True:
                 conn = None
                 client = None
+                addr = None
                 try:
                     # Accept new client connection.
                     conn, addr = sock.accept()
 
-                    # Create client and add to list of open connections.
+                    # Test if server already has too many sessions.
+                    if not self.admit():
+                        self.reject(conn, addr)
+                        continue
+
+                    # Create client and add to open connections.
+                    SocketOptions.of(self.config, CONTROL).connected(conn)
                     client = Connection(conn, addr)
-                    self.open_connections.append(client)
+                    add_connection(client)
                     log('Connected to new client.', client)
 
-                    # Create and start new thread to serve the client.
-                    t = threading.Thread(
-                        target=self.serve_client, args=(client,))
-                    t.start()
+                    # Queue the client to be served by the next free worker.
+                    self.pool.submit(self.serve_client, client)
 
                 except KeyboardInterrupt:
                     self.close_all(client, conn, addr)
+                    self.pool.shutdown()
                     break
 
+    def admit(self):
+        '''admit() -> boolean
+        Reserve a session for a new client. Returns False if the server already
+        has as many sessions as session_limit() allows.'''
+
+        with self.lock:
+            # Test if server is full.
+            if self.sessions >= self.session_limit():
+                self.rejected += 1
+                self.metrics.inc('sessions_rejected_total')
+                return False
+
+            self.sessions += 1
+            self.metrics.inc('sessions_total')
+            return True
+
+    def session_limit(self):
+        '''session_limit() -> maximum number of sessions
+        Each session holds a worker thread, so there are never more sessions
+        than worker threads; a client beyond them would get no greeting until
+        a worker is free.'''
+
+        return min(self.config.max_sessions, self.config.worker_threads)
+
+    def release(self):
+        '''release()
+        Release a session reserved by admit().'''
+
+        with self.lock:
+            self.sessions -= 1
+
+    def reject(self, conn, addr):
+        '''reject(conn, addr)
+        Tell a client the server is full and close its connection.'''
+
+        try:
+            conn.sendall(System.encode('421 Too many connections.\r\n'))
+        except OSError:
+            pass
+
+        conn.close()
+        log(f'{addr[0]}:{addr[1]} Rejected client: too many connections.')
+
+    def counters(self):
+        '''counters() -> dictionary of counter name to value
+        Return the live admission, worker, and cache counters.'''
+
+        with self.lock:
+            c = {'sessions': self.sessions, 'rejected': self.rejected}
+
+        c['data_connections'] = self.open_connections.data_count()
+        c.update(self.worker_counters())
+        for name, value in self.listings.counters().items():
+            c[f'listing_cache_{name}'] = value
+        for name, value in self.files.counters().items():
+            c[f'file_cache_{name}'] = value
+        for name, value in self.maps.counters().items():
+            c[f'file_maps_{name}'] = value
+        for name, value in File.PATHS.counters().items():
+            c[f'path_cache_{name}'] = value
+        for name, value in self.ports.counters().items():
+            c[f'pasv_ports_{name}'] = value
+        for name, value in self.auth.counters().items():
+            c[f'auth_{name}'] = value
+
+        return c
+
+    def start_exporter(self):
+        '''start_exporter()
+        Serve the metrics over HTTP if a metrics port is configured.'''
+
+        # Test if metrics exporter is enabled.
+        if self.config.metrics_port:
+            self.exporter = MetricsExporter(
+                self.metrics, self.config.metrics_port)
+            log(f'Serving metrics at 127.0.0.1:{self.config.metrics_port}.')
+
+    def start_reaper(self):
+        '''start_reaper()
+        Start the reaper of idle sessions.'''
+
+        self.reaper = Reaper(self.config.reaper_interval,
+                             self.config.idle_timeout,
+                             self.open_connections.snapshot, log)
+
+    def listen(self):
+        '''listen() -> socket
+        Create the socket that listens for client connections, with the
+        options of control connections, and bind it to the server's address.'''
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            SocketOptions.of(self.config, CONTROL).listening(sock)
+
+            # Test if port is shared with other worker processes.
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+            # Bind socket.
+            sock.bind((self.config.listen_address, self.port))
+            log(f'Binding to address: {self.address()}.')
+
+            sock.listen(self.config.listen_backlog)
+
+        except:
+            sock.close()
+            raise
+
+        return sock
+
+    def address(self):
+        '''address() -> address:port the server listens on'''
+
+        return f'{self.config.listen_address or "0.0.0.0"}:{self.port}'
+
+    def start_watcher(self):
+        '''start_watcher()
+        Start the thread that reloads the config file when it changes or when
+        a reload is requested.'''
+
+        self.watcher.start()
+
+    def request_reload(self):
+        '''request_reload()
+        Ask for the config file to be reloaded now, such as on SIGHUP. Safe to
+        call from a signal handler.'''
+
+        self.watcher.request()
+
+    def reload(self):
+        '''reload()
+        Read the config file and apply it. A config file with errors is
+        ignored. Settings that only take effect on restart keep their old
+        values.'''
+
+        config = System.config()
+        error = config.error(PORT_MIN, PORT_MAX)
+
+        # Test if config file has errors.
+        if error:
+            log(f'Config file not reloaded: {error}')
+            return
+
+        if self.partition:
+            config = config.for_worker(*self.partition)
+
+        restart = []
+        for name in Config.RESTART_ATTRIBUTES:
+            if getattr(config, name) != getattr(self.config, name):
+                restart.append(name)
+                setattr(config, name, getattr(self.config, name))
+
+        changed = self.config.changes(config)
+        if changed:
+            self.apply(config)
+            log(f'Reloaded config file: changed {", ".join(changed)}.')
+
+        if restart:
+            log(f'Restart the server to change {", ".join(restart)}.')
+
+    def apply(self, config):
+        '''apply(config)
+        Make config the server's config. Sessions and transfers that start
+        afterwards use the new settings; caches, the passive port pool, rate
+        limits, and the reaper are changed in place.'''
+
+        self.config = config
+        configure_log(self.logger, config)
+
+        self.listings.resize(config.listing_cache_bytes)
+        self.files.resize(Server.file_cache_bytes(config))
+        File.PATHS.ttl = config.path_cache_ms / 1000
+        self.ports.resize(config.pasv_min_port, config.pasv_max_port)
+        self.auth.configure(config.auth_cache_size, config.login_max_failures,
+                            config.login_failure_window)
+        self.shaper.configure(
+            config.download_rate, config.upload_rate,
+            config.user_download_rate, config.user_upload_rate)
+
+        if self.reaper:
+            self.reaper.interval = config.reaper_interval
+            self.reaper.idle_timeout = config.idle_timeout
+
+    @staticmethod
+    def file_cache_bytes(config):
+        '''file_cache_bytes(config) -> budget of the file cache in bytes
+        Files kept in memory are not cached twice.'''
+
+        if config.memory_storage:
+            return 0
+
+        return config.file_cache_bytes
+
+    def timed_out(self, kind):
+        '''timed_out(kind)
+        Count a timeout of kind, such as "idle" or "data_stall".'''
+
+        self.metrics.inc('timeouts_total', kind=kind)
+        if self.reaper:
+            self.reaper.count(kind)
+
+    def throttled(self, direction, wait):
+        '''throttled(direction, wait)
+        Count the seconds a transfer waited for its rate limit.'''
+
+        self.metrics.inc('throttled_seconds_total', wait, direction=direction)
+
+    def worker_counters(self):
+        '''worker_counters() -> dictionary of counter name to value
+        Return the live worker pool counters.'''
+
+        if not self.pool:
+            return {'active_workers': 0, 'queue_depth': 0}
+
+        return {'active_workers': self.pool.active_workers(),
+                'queue_depth': self.pool.queue_depth()}
+
+    def listen_passive(self, data_conn):
+        '''listen_passive(data_conn)
+        Wait for the client to connect to a Passive Mode data connection. The
+        listening socket is handed to the server's acceptor, which waits on all
+        of them from one thread and gives up after data_accept_timeout seconds.'''
+
+        self.acceptor.add(data_conn.listener, data_conn.accepted,
+                          data_conn.accept_timed_out,
+                          self.config.data_accept_timeout)
+
+    def unlisten_passive(self, listener):
+        '''unlisten_passive(listener)
+        Stop waiting for the client to connect to a Passive Mode data connection
+        and close its listening socket, taken from the data connection.'''
+
+        self.acceptor.remove(listener)
+
     def server_params(self):
         '''server_params() -> (address family, boolean)
         Determine if the platform supports dualstack IPv6. If it does, then set
@@ -103,15 +441,18 @@ class Server:
     def close_all(self, client, conn, addr):
         '''close_all(client, conn)
         Terminate the server. Close all open control and data connections and
-        remove them from list of open connections.'''
+        remove them from the registry of open connections.'''
 
-        # Test if last connection is open but not in open list.
+        if self.reaper:
+            self.reaper.close()
+
+        # Test if last connection is open but not registered.
         if self.connection_not_in_list(conn, client):
-            # Instantiate a new client and append to open list.
-            self.open_connections.append(Connection(conn, addr))
+            # Instantiate a new client and add to open connections.
+            add_connection(Connection(conn, addr))
 
         # Close all open connections.
-        for c in self.open_connections:
+        for c in self.open_connections.snapshot():
             if c.data_conn:
                 try:
                     c.data_conn.close()
@@ -129,7 +470,7 @@ class Server:
     def connection_not_in_list(self, conn, client):
         '''connection_not_in_list(self, conn, client) -> boolean
         Test if a client connection is open but has not yet been added the the
-        server's list of open client connections.'''
+        server's registry of open client connections.'''
 
         if (conn and client and client not in self.open_connections) or (conn and not client):
             return True
@@ -142,28 +483,52 @@ class Server:
         the client based on the current state, receives client response, and
         updates the current state.'''
 
-        with client.conn:
-            while True:
-                # Send current state reply to client.
-                client.sendall()
-
-                # Receive decoded client response.
-                data = client.recvall()
-
-                # Test if user closed connection.
-                if not data:
-                    log(f'Client closed connection.', client)
-                    break
-
-                log(f'Received: {data}', client)
-
-                # Parse client response and update current state.
-                command, value = self.parse_response(data)
-                client.update(command, value)
-
-        # Remove connection from list of open connections.
-        client.close()
-        remove_connection(client)
+        try:
+            with client.conn:
+                # Test if session expired while waiting for a worker.
+                if client.timed_out:
+                    return
+
+                while True:
+                    # Send current state reply to client.
+                    client.sendall()
+
+                    # Test if client ended the session.
+                    if client.has_quit:
+                        break
+
+                    # Receive the next command line.
+                    try:
+                        line = client.recvline()
+                    except TimeoutError:
+                        client.time_out()
+                        continue
+
+                    # Test if user closed connection.
+                    if line is None:
+                        log(f'Client closed connection.', client)
+                        break
+
+                    # Test if command line is too long.
+                    if line is TOO_LONG:
+                        client.state.set_reply('500', 'Command line too long.')
+                        continue
+
+                    data = System.decode(line)
+                    log(f'Received: {data}', client)
+
+                    # Parse client response and update current state.
+                    command, value = self.parse_response(data)
+                    client.update(command, value)
+
+        except (ConnectionError, TimeoutError):
+            log(f'Client connection lost.', client)
+
+        finally:
+            # Remove connection from registry of open connections.
+            client.close()
+            remove_connection(client)
+            self.release()
 
     def parse_response(self, response):
         '''parse(response) -> (command, value)
@@ -196,10 +561,306 @@ class Server:
         return command, value
 
 
+# Commands that do no disk or network I/O and so are run directly on the event
+# loop by the AsyncServer. All other commands are run in its executor.
+LOOP_COMMANDS = ['USER', 'PWD', 'SYST', 'TYPE', 'MODE', 'FEAT', 'REST',
+                 'PASV', 'EPSV', 'PORT', 'EPRT', 'REIN']
+
+
+class AsyncServer(Server):
+    '''AsyncServer
+    An FTP server that serves all control connections and Passive Mode accepts
+    from a single asyncio event loop instead of a thread per connection. The
+    command semantics are those of Connection; commands that block on the disk
+    or on a data connection are run in a bounded thread pool executor.'''
+
+    def __init__(self, filename, port, config, logger=None, reuse_port=False):
+        super().__init__(filename, port, config, logger, reuse_port)
+        self.loop = None
+        self.executor = ThreadPoolExecutor(max_workers=config.async_workers)
+        self.jobs = 0
+
+    def start(self):
+        '''start()
+        Run the event loop until the server is interrupted.'''
+
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.close_all(None, None, None)
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def serve(self):
+        '''serve()
+        Create the listening socket and serve clients until cancelled.'''
+
+        self.loop = asyncio.get_running_loop()
+        self.start_exporter()
+        self.start_reaper()
+        self.start_watcher()
+        srv = await asyncio.start_server(self.serve_client, sock=self.listen())
+
+        async with srv:
+            await srv.serve_forever()
+
+    async def serve_client(self, reader, writer):
+        '''serve_client(reader, writer)
+        Provides the services of the FTP server to a client. Same exchange as
+        Server.serve_client but waiting on the event loop instead of a thread.'''
+
+        # Test if server already has too many sessions.
+        if not self.admit():
+            self.reject(AsyncChannel(self.loop, writer),
+                        writer.get_extra_info('peername'))
+            return
+
+        SocketOptions.of(self.config, CONTROL).connected(
+            writer.get_extra_info('socket'))
+        client = Connection(AsyncChannel(self.loop, writer),
+                            writer.get_extra_info('peername'))
+        add_connection(client)
+        log('Connected to new client.', client)
+
+        try:
+            while True:
+                # Send current state reply to client.
+                client.sendall()
+                await writer.drain()
+
+                # Test if client ended the session.
+                if client.has_quit:
+                    break
+
+                # Receive the next command line.
+                try:
+                    line = await self.readline(reader, client)
+                except asyncio.TimeoutError:
+                    client.time_out()
+                    continue
+
+                # Test if user closed connection.
+                if line is None:
+                    log(f'Client closed connection.', client)
+                    break
+
+                # Test if command line is too long.
+                if line is TOO_LONG:
+                    client.state.set_reply('500', 'Command line too long.')
+                    continue
+
+                data = System.decode(line)
+                log(f'Received: {data}', client)
+
+                # Parse client response and update current state.
+                command, value = self.parse_response(data)
+                if command and command.upper() in LOOP_COMMANDS:
+                    client.update(command, value)
+                else:
+                    self.jobs += 1
+                    try:
+                        await self.loop.run_in_executor(
+                            self.executor, client.update, command, value)
+                    finally:
+                        self.jobs -= 1
+
+        except ConnectionError:
+            log(f'Client connection lost.', client)
+
+        except asyncio.CancelledError:
+            # The server is shutting down; end the task normally so asyncio
+            # does not report it as an unhandled error.
+            pass
+
+        finally:
+            # Remove connection from registry of open connections.
+            client.close()
+            remove_connection(client)
+            writer.close()
+            self.release()
+
+    async def readline(self, reader, client, bufsize=4096):
+        '''readline(reader, client, bufsize=4096) -> line, TOO_LONG, or None
+        Same as Connection.recvline but waiting on the event loop for data.
+        Raises asyncio.TimeoutError if no data arrives for idle_timeout
+        seconds.'''
+
+        while True:
+            line = client.lines.next_line()
+            if line is not None:
+                return line
+
+            data = await asyncio.wait_for(
+                reader.read(bufsize), self.config.idle_timeout or None)
+
+            # Test if client closed connection.
+            if not data:
+                return None
+
+            client.lines.feed(data)
+
+    def session_limit(self):
+        '''session_limit() -> maximum number of sessions
+        Sessions only hold an executor thread while a command runs, so they
+        are limited by max_sessions alone.'''
+
+        return self.config.max_sessions
+
+    def worker_counters(self):
+        '''worker_counters() -> dictionary of counter name to value
+        Return the live executor counters.'''
+
+        return {'executor_jobs': self.jobs}
+
+    def listen_passive(self, data_conn):
+        '''listen_passive(data_conn)
+        Wait on the event loop for the client to connect to a Passive Mode
+        data connection. May be called from any thread.'''
+
+        self.call_in_loop(self.add_passive, data_conn)
+
+    def call_in_loop(self, callback, *args):
+        '''call_in_loop(callback, *args)
+        Call callback now if on the event loop thread, otherwise schedule it to
+        be called by the event loop.'''
+
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+
+        if in_loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def add_passive(self, data_conn):
+        '''add_passive(data_conn)
+        Register the data connection's listening socket with the event loop.'''
+
+        listener = data_conn.listener
+
+        # Test if data connection was closed before it was registered.
+        if not listener:
+            return
+
+        listener.setblocking(False)
+        self.loop.add_reader(
+            listener.fileno(), self.accept_passive, data_conn, listener)
+        self.loop.call_later(self.config.data_accept_timeout,
+                             self.expire_passive, data_conn, listener)
+
+    def expire_passive(self, data_conn, listener):
+        '''expire_passive(data_conn, listener)
+        Stop waiting for a client that did not connect in time.'''
+
+        # Test if client connected or data connection was closed.
+        if data_conn.listener is not listener:
+            return
+
+        self.remove_passive(listener)
+        data_conn.accept_timed_out()
+
+    def accept_passive(self, data_conn, listener):
+        '''accept_passive(data_conn, listener)
+        Accept the client on a readable Passive Mode listening socket.'''
+
+        # Test if data connection was closed; remove_passive cleans up.
+        if data_conn.listener is not listener:
+            return
+
+        try:
+            conn, addr = listener.accept()
+        except BlockingIOError:
+            return
+        except OSError:
+            conn = None
+
+        self.loop.remove_reader(listener.fileno())
+
+        # Test if accept failed; close the listener and wake the waiter.
+        if not conn:
+            self.remove_passive(listener)
+            data_conn.accept_timed_out()
+            return
+
+        # Data transfers are done with blocking sockets in the executor.
+        conn.setblocking(True)
+        data_conn.accepted(conn, addr)
+
+    def unlisten_passive(self, listener):
+        '''unlisten_passive(listener)
+        Stop waiting for the client to connect. The listening socket is closed
+        on the event loop so it is never closed while still registered.'''
+
+        self.call_in_loop(self.remove_passive, listener)
+
+    def remove_passive(self, listener):
+        '''remove_passive(listener)
+        Unregister and close a Passive Mode listening socket.'''
+
+        try:
+            self.loop.remove_reader(listener.fileno())
+        except ValueError:
+            pass
+
+        listener.close()
+
+
+class AsyncChannel:
+    '''AsyncChannel
+    Adapts an asyncio stream writer to the blocking socket interface used by
+    Connection so replies can be sent from the event loop or from an executor
+    thread.'''
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.family = writer.get_extra_info('socket').family
+
+    def sendall(self, data):
+        '''sendall(data)
+        Write data to the client, by way of the event loop if called from
+        another thread.'''
+
+        server.call_in_loop(self.writer.write, data)
+
+    def close(self):
+        '''close()
+        Close the control connection.'''
+
+        server.call_in_loop(self.writer.close)
+
+    def shutdown(self, how):
+        '''shutdown(how)
+        End the control connection once the replies already written are
+        sent, so the session's task reads the end of the stream.'''
+
+        self.close()
+
+
+TYPE_ASCII = 'A'
+TYPE_IMAGE = 'I'
+TYPES = {TYPE_ASCII: 'ASCII', TYPE_IMAGE: 'Binary'}
+
+MODE_STREAM = 'S'
+MODE_DEFLATE = 'Z'
+MODES = [MODE_STREAM, MODE_DEFLATE]
+
 LIST = 'LIST'
+NLST = 'NLST'
 RETR = 'RETR'
 STOR = 'STOR'
-DATA_COMMANDS = [LIST, RETR, STOR]
+APPE = 'APPE'
+
+# Maximum length in bytes of a command line, including its CRLF.
+MAX_LINE = 4096
+
+# Bytes sent by each sendfile call of a download that is not rate limited.
+SENDFILE_CHUNK = 16 * 1024 * 1024
+
+# Extensions listed in reply to FEAT.
+FEATURES = ['EPRT', 'EPSV', 'MODE Z', 'PASV', 'REST STREAM', 'SIZE']
 
 
 class Connection:
@@ -209,6 +870,14 @@ class Connection:
         self.addr = addr[0]
         self.port = addr[1]
         self.data_conn = None
+        self.session_id = None
+        self.lines = LineBuffer(MAX_LINE)
+        self.has_quit = False
+        self.timed_out = False
+
+        # When the session started waiting for its next command, or None
+        # while a command is being performed.
+        self.idle_since = time.monotonic()
         self.initialize()
 
     def initialize(self):
@@ -218,7 +887,11 @@ class Connection:
         self.state = State()
         self.user = ''
         self.is_logged_in = False
+        self.read_only = False
         self._dir = ''
+        self.type = TYPE_ASCII
+        self.mode = MODE_STREAM
+        self.rest = 0
 
     def addr_info(self):
         return f'{self.addr}:{self.port}'
@@ -229,23 +902,58 @@ class Connection:
 
         msg = self.state.get_reply()
         self.conn.sendall(System.encode(msg))
+        server.metrics.inc('replies_total', code=self.state.code)
         log(f'Sent: {msg}', self)
 
-    def recvall(self, bufsize=4096):
-        '''recvall(bufsize=4096) -> response data
-        Receive, decode, and return all response data over control connection.'''
+    def recvline(self, bufsize=4096):
+        '''recvline(bufsize=4096) -> line, TOO_LONG, or None
+        Return the next command line received over control connection. Data is
+        only received when no complete line is buffered, so commands a client
+        pipelines are answered without waiting on the network. Returns None if
+        the client closed the connection. Raises TimeoutError if no data
+        arrives for idle_timeout seconds, as currently configured.'''
 
-        data = b''
         while True:
-            # Receive some data.
-            res = self.conn.recv(bufsize)
-            data += res
-
-            # Test if end of message.
-            if len(res) < bufsize:
-                break
+            line = self.lines.next_line()
+            if line is not None:
+                return line
 
-        return System.decode(data)
+            # Only waiting for a command times out, not sending a reply.
+            self.conn.settimeout(server.config.idle_timeout or None)
+            try:
+                data = self.conn.recv(bufsize)
+            finally:
+                self.conn.settimeout(None)
+
+            # Test if client closed connection.
+            if not data:
+                return None
+
+            self.lines.feed(data)
+
+    def time_out(self):
+        '''time_out()
+        End a session that sent no command for idle_timeout seconds.'''
+
+        log('Timed out waiting for a command.', self)
+        server.timed_out('idle')
+        self.state.set_reply('421', 'Timeout.')
+        self.has_quit = True
+
+    def expire(self):
+        '''expire()
+        End a session that has been idle for too long from another thread:
+        tell the client and shut the control connection down, so the thread or
+        task serving the session sees it closed and cleans up.'''
+
+        self.timed_out = True
+        log('Session expired by reaper.', self)
+        server.timed_out('idle')
+        try:
+            self.conn.sendall(System.encode('421 Timeout.\r\n'))
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def close(self):
         '''close()
@@ -261,74 +969,108 @@ class Connection:
             except:
                 pass
 
-        # TODO: is the 421 sent on a normal QUIT?
-        # self.state.set_reply(
-        #     '421', 'Service not available, closing control connection.')
-        # self.sendall()
-
-        # Remove connection from list of open connections.
+        # Remove connection from registry of open connections.
         remove_connection(self)
 
     def update(self, command, value):
         '''update(command, value)
-        Performs the client's command.'''
+        Performs the client's command: looks it up in the command registry,
+        checks that it may be used now, and calls its handler. The time taken
+        is recorded in the command's latency histogram.'''
+
+        start = time.monotonic()
+        self.idle_since = None
+        cmd = COMMANDS.get(command)
+
+        # Test if command may be used before logging in.
+        if cmd and not cmd.needs_login:
+            cmd.handler(self, value)
 
         # Test if user not logged in.
-        if not self.is_logged_in:
+        elif not self.is_logged_in:
             self.login(command, value)
 
+        # Test if command not supported.
+        elif not cmd:
+            self.state.set_reply('500', 'Unknown command.')
+
+        # Test if command changes files and user may only read them.
+        elif cmd.writes and self.read_only:
+            self.state.set_reply('550', 'Permission denied.')
+            if self.data_conn:
+                self.data_conn.close()
+                self.data_conn = None
+
+        # Test if command transfers data.
+        elif cmd.needs_data:
+            self.transfer(cmd, value)
+
         else:
-            if command == 'CWD':
-                self.cwd(value)
-            elif command == 'CDUP':
-                self.cdup()
-            elif command == 'PWD':
-                self.pwd()
-            elif command == 'SYST':
-                self.syst()
-            elif command == 'PASV':
-                self.pasv()
-            elif command == 'EPSV':
-                self.epsv(value)
-            elif command == 'PORT':
-                self.port_cmd(value)
-            elif command == 'EPRT':
-                self.eprt(value)
-            elif command == 'REIN':
-                self.initialize()
-            elif command == 'QUIT':
-                self.close()
+            cmd.handler(self, value)
 
-            else:
-                # Test if command not supported.
-                if command not in DATA_COMMANDS:
-                    self.state.set_reply('500', 'Unknown command.')
+        # Only known commands get their own histogram.
+        verb = command
+        if command not in COMMANDS and command not in LOGIN_COMMANDS:
+            verb = 'OTHER'
 
-                # Test if data connection was not created.
-                elif not self.data_conn:
-                    self.state.set_reply('425', 'Use PORT or PASV first.')
+        server.metrics.observe('command_duration_seconds',
+                               time.monotonic() - start, LATENCY_BUCKETS,
+                               command=verb)
 
-                else:
-                    # Test if Active Mode.
-                    if self.data_conn.is_active_mode:
-                        # Connect data connection to client.
-                        self.data_conn.connect()
-
-                    # Test if Passive Mode.
-                    else:
-                        # Wait for client to connect to data connection.
-                        self.data_conn.connected.wait()
-
-                    if command == LIST:
-                        self.ls(value)
-                    elif command == RETR:
-                        self.retr(value)
-                    elif command == STOR:
-                        self.stor(value)
-
-                    # Cleanup data connection.
-                    self.data_conn.close()
-                    self.data_conn = None
+        # Keep the session metadata up to date.
+        server.open_connections.update(
+            self.session_id, user=self.user, cwd=self._dir)
+        self.idle_since = time.monotonic()
+
+    def transfer(self, cmd, value):
+        '''transfer(cmd, value)
+        Performs a command that transfers data over the data connection.'''
+
+        # Test if data connection was not created.
+        if not self.data_conn:
+            self.state.set_reply('425', 'Use PORT or PASV first.')
+            return
+
+        timeout = server.config.data_connect_timeout
+
+        # Data is deflated on the wire in MODE Z.
+        self.data_conn.deflate = self.mode == MODE_DEFLATE
+
+        # Data is sent and received at the user's and the server's rates.
+        self.data_conn.download = server.shaper.limiter(self.user, DOWNLOAD)
+        self.data_conn.upload = server.shaper.limiter(self.user, UPLOAD)
+
+        # Test if Active Mode.
+        if self.data_conn.is_active_mode:
+            # Connect data connection to client.
+            connected = self.data_conn.connect(timeout)
+
+        # Test if Passive Mode.
+        else:
+            # Wait for client to connect to data connection.
+            connected = self.data_conn.wait_connected(timeout)
+
+        if not connected:
+            self.state.set_reply('425', 'Failed to establish connection.')
+            server.timed_out('data_connect')
+
+        else:
+            try:
+                cmd.handler(self, value)
+
+            # Test if client stopped sending or receiving data.
+            except TimeoutError:
+                log('Data transfer stalled.', self)
+                server.timed_out('data_stall')
+                self.state.set_reply('421', 'Data timeout. Reconnect.')
+                self.has_quit = True
+
+        # A restart position only applies to one transfer.
+        self.rest = 0
+
+        # Cleanup data connection.
+        self.data_conn.close()
+        self.data_conn = None
 
     def login(self, command, value):
         '''login(command, value)
@@ -349,18 +1091,30 @@ class Connection:
 
         else:
             if command == 'PASS':
+                user, allowed = server.auth.login(self.user, value, self.addr)
+
+                # Test if client failed to log in too often.
+                if not allowed:
+                    self.user = ''
+                    self.state.set_reply(
+                        '530', 'Too many failed logins, try again later.')
+                    server.metrics.inc('logins_total', result='blocked')
+
                 # Test if username and password are valid.
-                if System.credentials_are_correct(self.user, value):
+                elif user:
                     # Set login status.
                     self.is_logged_in = True
+                    self.read_only = user.read_only
                     self.state.set_reply('230', 'Login successful.')
+                    server.metrics.inc('logins_total', result='ok')
 
                     # Change directory to user home.
-                    self._dir = File.get_home_dir(self.user)
+                    self._dir = File.get_home_dir(user.home)
 
                 else:
                     self.user = ''
                     self.state.set_reply('530', 'Login incorrect.')
+                    server.metrics.inc('logins_total', result='failed')
 
             elif command == 'USER':
                 self.state.set_reply('331', 'Please specify password.')
@@ -402,10 +1156,120 @@ class Connection:
 
         self.state.set_reply('215', System.system_info())
 
-    def ls(self, path=None):
-        '''ls(path):
+    def type_cmd(self, value):
+        '''type_cmd(value)
+        Set the transfer type. Files are always transferred byte for byte, the
+        type is only recorded so clients that request it get a positive reply.'''
+
+        # Only the type code matters; ignore any format control (e.g. "A N").
+        t = value.strip().upper()[:1]
+
+        # Test if transfer type is not supported.
+        if t not in TYPES:
+            self.state.set_reply('504', 'Unrecognised TYPE command.')
+
+        else:
+            self.type = t
+            self.state.set_reply('200', f'Switching to {TYPES[t]} mode.')
+
+    def mode_cmd(self, value):
+        '''mode_cmd(value)
+        Set the transfer mode: S for stream or Z for deflate compressed.'''
+
+        m = value.strip().upper()
+
+        # Test if transfer mode is not supported.
+        if m not in MODES:
+            self.state.set_reply('504', 'Bad MODE command.')
+
+        else:
+            self.mode = m
+            self.state.set_reply('200', f'Mode set to {m}.')
+
+    def stat(self, value):
+        '''stat(value)
+        Display the server status: the live session and worker counters.'''
+
+        # Test if a path was given.
+        if value:
+            self.state.set_reply(
+                '504', 'Command not implemented for that parameter.')
+
+        else:
+            lines = ['FTP server status:']
+            lines += [f'{k}: {v}' for k, v in server.counters().items()]
+            lines.append('End of status')
+            self.state.set_reply('211', lines)
+
+    def site(self, value):
+        '''site(value)
+        Perform a site specific command. SITE STATS displays the metrics,
+        SITE LATENCY the latency quantiles of each command, and SITE SESSIONS
+        the metadata of each open session.'''
+
+        cmd = value.strip().upper()
+
+        if cmd == 'STATS':
+            lines = ['Server statistics:'] + server.metrics.summary()
+            lines.append('End of statistics')
+            self.state.set_reply('211', lines)
+
+        elif cmd == 'LATENCY':
+            lines = ['Command latency in milliseconds:']
+            latency = server.metrics.quantiles('command_duration_seconds')
+            for labels, q in sorted(latency.items()):
+                ms = ' '.join(f'{k}={v * 1000:.3f}' for k, v in q.items()
+                              if k != 'count')
+                lines.append(f'{dict(labels)["command"]}: count={q["count"]} {ms}')
+
+            lines.append('End of latency')
+            self.state.set_reply('211', lines)
+
+        elif cmd == 'SESSIONS':
+            lines = ['Open sessions:']
+            now = time.time()
+            for s in server.open_connections.session_info():
+                lines.append(
+                    f'{s["session_id"]} {s["addr"]} user={s["user"] or "-"} '
+                    f'cwd={s["cwd"]} '
+                    f'connected={now - s["connected"]:.0f}s '
+                    f'sent={s["bytes_sent"]} received={s["bytes_received"]}')
+
+            lines.append('End of sessions')
+            self.state.set_reply('211', lines)
+
+        else:
+            self.state.set_reply('500', 'Unknown SITE command.')
+
+    def record_transfer(self, command, nbytes, start):
+        '''record_transfer(command, nbytes, start)
+        Count a completed transfer of nbytes that started at time start.'''
+
+        seconds = time.monotonic() - start
+        metrics = server.metrics
+        metrics.inc('transfers_total', command=command)
+        metrics.observe('transfer_duration_seconds', seconds,
+                        DURATION_BUCKETS, command=command)
+
+        # Test if transfer took a measurable time.
+        if seconds > 0:
+            metrics.observe('transfer_rate_bytes_per_second', nbytes / seconds,
+                            RATE_BUCKETS, command=command)
+
+        # Count the bytes by direction.
+        if command in (STOR, APPE):
+            metrics.inc('bytes_received_total', nbytes)
+        else:
+            metrics.inc('bytes_sent_total', nbytes)
+
+    def ls(self, path=None, names_only=False):
+        '''ls(path, names_only=False):
         List the files at the provided path or in the current working directory
-        if no path.'''
+        if no path. If names_only then only the names are listed (NLST).'''
+
+        # Ignore "ls" style options such as "-la" that some clients send.
+        if path and path.startswith('-'):
+            path = path.partition(' ')[2].strip()
 
         # Test if a path was given.
         if path:
@@ -423,32 +1287,109 @@ class Connection:
             self.state.set_reply('150', 'Here comes the directory listing.')
             self.sendall()
 
-            # Send LIST data.
-            self.data_conn.ls(realpath)
+            # Send LIST or NLST data.
+            start = time.monotonic()
+            nbytes = self.data_conn.ls(realpath, names_only)
+            self.record_transfer(NLST if names_only else LIST, nbytes, start)
             self.state.set_reply('226', 'Directory send OK.')
 
-    def stor(self, value):
-        '''stor(value)
-        Store a file that the client will send over data channel.'''
+    def quit(self):
+        '''quit()
+        End the session. The server closes the control connection once the
+        reply is sent, so no command pipelined after QUIT is performed.'''
+
+        # Abandon any data connection that was opened but not used.
+        if self.data_conn:
+            self.data_conn.close()
+            self.data_conn = None
+
+        self.has_quit = True
+        self.state.set_reply('221', 'Goodbye.')
+
+    def feat(self):
+        '''feat()
+        List the extensions the server supports.'''
+
+        lines = ['Features:'] + FEATURES + ['End']
+        self.state.set_reply('211', lines)
+
+    def size(self, value):
+        '''size(value)
+        Send the size in bytes of a file.'''
 
         # Get the absolute path.
         path = File.realpath(self._dir, value)
 
+        # Test if file does not exists or is not readable.
+        if not value or not File.isfile(path) or not File.isreadable(path):
+            self.state.set_reply('550', 'Could not get file size.')
+
+        else:
+            self.state.set_reply('213', str(File.get_file_size(path)))
+
+    def rest_cmd(self, value):
+        '''rest_cmd(value)
+        Set the byte offset at which the next RETR or STOR starts.'''
+
+        # Test if offset is not a non-negative integer.
+        try:
+            offset = int(value)
+            if offset < 0:
+                raise ValueError
+        except ValueError:
+            self.state.set_reply('501', 'REST requires a value >= 0.')
+            return
+
+        self.rest = offset
+        self.state.set_reply('350', f'Restart position accepted ({offset}).')
+
+    def stor(self, value, append=False):
+        '''stor(value, append=False)
+        Store a file that the client will send over data channel. If append
+        then the data is appended to the file (APPE); otherwise if a restart
+        position was set then the data overwrites the file from that offset.'''
+
+        # Get the absolute path.
+        path = File.realpath(self._dir, value)
+        offset = 0 if append else self.rest
+
         # Test if path not accessible.
         if not value or not File.can_write_file(path):
             self.state.set_reply('553', 'Could not create file.')
 
+        # Test if restart position is past the end of the file.
+        elif offset and (not File.isfile(path) or offset > File.get_file_size(path)):
+            self.state.set_reply('554', 'Invalid REST parameter.')
+
         else:
-            # Retrieve file from client and store it in file system.
-            self.state.set_reply('150', 'Ok to send data.')
-            self.sendall()
+            # Wait, at most as long as for a data connection, for downloads
+            # that map the file to finish.
+            with server.maps.writing(
+                    path, server.config.data_connect_timeout) as ready:
+                # Test if the file is still being downloaded.
+                if not ready:
+                    self.state.set_reply(
+                        '450', 'File busy, try again later.')
+                    return
+
+                # Retrieve file from client and store it in file system.
+                self.state.set_reply('150', 'Ok to send data.')
+                self.sendall()
 
-            self.data_conn.stor(path)
-            self.state.set_reply('226', 'Transfer complete.')
+                try:
+                    start = time.monotonic()
+                    nbytes = self.data_conn.stor(path, offset, append)
+                    self.record_transfer(
+                        APPE if append else STOR, nbytes, start)
+                    self.state.set_reply('226', 'Transfer complete.')
+                except zlib.error:
+                    self.state.set_reply(
+                        '451', 'Transfer aborted: bad compressed data.')
 
     def retr(self, value):
         '''retr(value)
-        Send a file to the client over data channel.'''
+        Send a file to the client over data channel, starting at the restart
+        position if one was set.'''
 
         # Get the absolute path.
         path = File.realpath(self._dir, value)
@@ -457,16 +1398,22 @@ class Connection:
         if not File.isfile(path) or not File.isreadable(path):
             self.state.set_reply('550', 'Failed to open file.')
 
+        # Test if restart position is past the end of the file.
+        elif self.rest > File.get_file_size(path):
+            self.state.set_reply('554', 'Invalid REST parameter.')
+
         else:
-            # Get file size.
-            nbytes = File.get_file_size(path)
+            # Get number of bytes to send.
+            nbytes = File.get_file_size(path) - self.rest
 
             # Send file to client.
             self.state.set_reply(
                 '150', f'Opening data connection for {value} ({nbytes} bytes).')
             self.sendall()
 
-            self.data_conn.retr(path)
+            start = time.monotonic()
+            nbytes = self.data_conn.retr(path, self.rest)
+            self.record_transfer(RETR, nbytes, start)
             self.state.set_reply('226', 'Transfer complete.')
 
     def pasv(self):
@@ -483,6 +1430,12 @@ class Connection:
             log(f'Opening Passive Mode data connection.', self)
             port = self.open_passive_conn()
 
+            # Test if no port was free.
+            if not port:
+                self.state.set_reply(
+                    '425', 'Cannot open passive connection: no free port.')
+                return
+
             # Convert port number into p1 and p2: port = (p1 * 256) + p2
             p1, p2 = self.convert_port_to_p1p2(port)
 
@@ -511,6 +1464,12 @@ class Connection:
             log(f'Opening Extended Passive Mode data connection.', self)
             port = self.open_passive_conn(net_prt)
 
+            # Test if no port was free.
+            if not port:
+                self.state.set_reply(
+                    '425', 'Cannot open passive connection: no free port.')
+                return
+
             # Set Extended Passive Mode reply.
             self.state.set_reply(
                 '229', f'Entering Extended Passive Mode (|||{port}|)')
@@ -680,30 +1639,45 @@ class Connection:
         return (int(p1) * 256) + int(p2)
 
     def open_passive_conn(self, net_prt=None):
-        '''open_passive_conn(net_prt=None) -> port number
-        Open a Passive Connection. Find an open port number on this machine,
-        create a data connection, and bind it to the port number.'''
+        '''open_passive_conn(net_prt=None) -> port number or None
+        Open a Passive Connection. Reserve a port number from the server's pool
+        of passive ports, create a data connection, and bind it to the port
+        number. Returns None if no port in the pool could be bound.'''
 
-        low = 50000
-        high = 60000
+        self.initialize_data_conn(net_prt=net_prt)
 
-        self.initialize_data_conn()
+        # Try each port in the pool at most once.
+        port = None
+        for _ in range(len(server.ports)):
+            port = server.ports.reserve()
+
+            # Test if every port is reserved.
+            if not port:
+                break
 
-        # Loop until found an open port.
-        while True:
-            # Get random port number within low and high.
-            port = System.randint(low, high)
             try:
                 # Attempt to bind to port.
-                self.data_conn.conn.bind(('', port))
+                self.data_conn.listener.bind(('', port))
+                self.data_conn.reserved_port = port
                 log(f'Binding data connection to: localhost:{port}.', self)
                 break
-            except:
-                pass
+            except OSError:
+                # Port is in use by another program; try the next one.
+                server.ports.release(port)
+                port = None
+
+        # Test if no port could be bound.
+        if not port:
+            log(f'No free passive port.', self)
+            self.data_conn.close()
+            self.data_conn = None
+            return None
 
-        # Create and start new thread to serve the data connection.
-        t = threading.Thread(target=self.data_conn.listen)
-        t.start()
+        # Listen before replying so the client can connect right away.
+        self.data_conn.listener.listen(1)
+
+        # Hand the listening socket to the server to accept the client.
+        server.listen_passive(self.data_conn)
 
         return port
 
@@ -711,72 +1685,252 @@ class Connection:
         '''initialize_data_conn(addr, net_prt=None, is_active_mode=False)
         Initialize a new DataConnection object with given host address.'''
 
+        # Close any data connection the client did not use.
+        if self.data_conn:
+            self.data_conn.close()
+            self.data_conn = None
+
         # Get address family and create connection.
         addr_fam = self.determine_addr_fam(net_prt)
         s = socket.socket(addr_fam, socket.SOCK_STREAM)
 
         # Create new data connection object.
-        self.data_conn = DataConnection(s, addr, is_active_mode)
+        if is_active_mode:
+            self.data_conn = DataConnection(
+                s, addr, is_active_mode, server.config,
+                session_id=self.session_id)
+        else:
+            self.data_conn = DataConnection(
+                config=server.config, listener=s, session_id=self.session_id)
+
+
+class Command:
+    '''Command
+    An entry of the command registry: the function that performs a command
+    given the connection and the command's value, and whether the command
+    needs the user to be logged in, needs a data connection, or writes files
+    so read only users may not use it.'''
+
+    def __init__(self, handler, needs_login=True, needs_data=False,
+                 writes=False):
+        self.handler = handler
+        self.needs_login = needs_login
+        self.needs_data = needs_data
+        self.writes = writes
+
+
+# Commands used to log in; they are performed by Connection.login.
+LOGIN_COMMANDS = ['USER', 'PASS']
+
+# The command registry: each command the server supports once logged in, or
+# before logging in if it does not need login.
+COMMANDS = {
+    'FEAT': Command(lambda c, v: c.feat(), needs_login=False),
+    'QUIT': Command(lambda c, v: c.quit(), needs_login=False),
+    'CWD': Command(Connection.cwd),
+    'CDUP': Command(lambda c, v: c.cdup()),
+    'PWD': Command(lambda c, v: c.pwd()),
+    'SYST': Command(lambda c, v: c.syst()),
+    'TYPE': Command(Connection.type_cmd),
+    'MODE': Command(Connection.mode_cmd),
+    'STAT': Command(Connection.stat),
+    'SITE': Command(Connection.site),
+    'SIZE': Command(Connection.size),
+    'REST': Command(Connection.rest_cmd),
+    'PASV': Command(lambda c, v: c.pasv()),
+    'EPSV': Command(Connection.epsv),
+    'PORT': Command(Connection.port_cmd),
+    'EPRT': Command(Connection.eprt),
+    'REIN': Command(lambda c, v: c.initialize()),
+    LIST: Command(Connection.ls, needs_data=True),
+    NLST: Command(lambda c, v: c.ls(v, names_only=True), needs_data=True),
+    RETR: Command(Connection.retr, needs_data=True),
+    STOR: Command(Connection.stor, needs_data=True, writes=True),
+    APPE: Command(lambda c, v: c.stor(v, append=True), needs_data=True,
+                  writes=True),
+}
 
 
 class DataConnection:
 
-    def __init__(self, conn=None, addr=None, is_active_mode=False):
+    def __init__(self, conn=None, addr=None, is_active_mode=False, config=None, listener=None, session_id=None):
         self.conn = conn
+        self.listener = listener
+        self.session_id = session_id
+        self.reserved_port = None
         self.addr = addr[0] if addr else None
         self.port = int(addr[1]) if addr else None
         self.connected = threading.Event()
+
+        # Guards the listener, conn, and reserved port, which the control
+        # connection and the thread accepting the client both change.
+        self.lock = threading.Lock()
         self.is_active_mode = is_active_mode
 
+        # Transfer settings are fixed for the lifetime of the connection.
+        config = config or Config()
+        self.bufsize = config.buffer_size
+        self.fsync_on_close = config.fsync_on_close
+        self.stall_timeout = config.data_stall_timeout or None
+        self.level = min(config.mode_z_level, 9)
+        self.cork = config.data_cork
+
+        # Set the options of this class of data connection before the socket
+        # connects or listens.
+        self.options = SocketOptions.of(
+            config, ACTIVE if is_active_mode else PASSIVE)
+        if listener:
+            self.options.listening(listener)
+        elif conn:
+            self.options.connecting(conn)
+
+        # Set by the control connection when the transfer mode is Z.
+        self.deflate = False
+        self.compressor = None
+
+        # Set by the control connection to the limiters of the user's rates.
+        self.download = None
+        self.upload = None
+
     def close(self):
         '''close()
-        Close the data connection and remove it from the server's list of open
-        connections.'''
+        Close the data connection and remove it from the server's registry of
+        open connections.'''
+
+        listener = self.take_listener()
+
+        # Test if still waiting for the client to connect in Passive Mode.
+        if listener:
+            server.unlisten_passive(listener)
 
         try:
+            # Send the end of the data at once, ahead of the 226 reply.
+            if self.cork:
+                cork(self.conn, False)
+
             self.conn.close()
             log('Closed data connection.', self)
         except:
             pass
 
-        # Remove connection from list of open connections.
-        remove_connection(self)
+        self.release_port()
 
-    def connect(self):
-        '''connect()
-        Connect data connection to host, add itself to server's list of open
-        connection, and set the "connected" event.'''
+        # Remove connection from registry of open connections.
+        remove_data_connection(self)
 
-        print(f'connecting to {self.addr}:{self.port}')
-        self.conn.connect((self.addr, self.port))
+    def connect(self, timeout=None):
+        '''connect(timeout=None) -> boolean
+        Connect data connection to host, add itself to server's registry of
+        open connections, and set the "connected" event. Returns False if the
+        connection could not be made within timeout seconds.'''
 
-        # Add data connection to server's list of open connections.
-        add_connection(self)
+        try:
+            self.conn.settimeout(timeout)
+            self.conn.connect((self.addr, self.port))
+            self.conn.settimeout(self.stall_timeout)
+        except OSError as err:
+            log(f'Failed to connect data connection: {err}.', self)
+            return False
+
+        self.tune()
+
+        # Add data connection to server's registry of open connections.
+        add_data_connection(self)
 
         # Set "connected" event.
         self.connected.set()
+        return True
 
-    def listen(self):
-        '''listen()
-        The data connection listens for a client to connect. This function is to
-        be called when a client selects Passive Mode to be used.'''
+    def wait_connected(self, timeout=None):
+        '''wait_connected(timeout=None) -> boolean
+        Wait for the client to connect to a Passive Mode data connection.
+        Returns False if the client did not connect within timeout seconds or
+        the server stopped waiting for it.'''
 
-        self.conn.listen(1)
-        try:
-            # Accept new client data connection.
-            conn, addr = self.conn.accept()
+        self.connected.wait(timeout)
+        return self.conn is not None
+
+    def accepted(self, conn, addr):
+        '''accepted(conn, addr)
+        Take over a client data connection accepted on the listening socket,
+        close the listening socket, and set the "connected" event.'''
+
+        with self.lock:
+            listener = self.listener
+
+            # Test if the data connection was closed while the client
+            # connected.
+            if not listener:
+                conn.close()
+                return
 
             # Overwrite Data Connection attributes.
+            self.listener = None
+            conn.settimeout(self.stall_timeout)
             self.conn = conn
             self.addr = addr[0]
             self.port = int(addr[1])
 
-            # Set "connected" event.
-            self.connected.set()
-            log('Connected to passive data channel.', self)
+        self.tune()
 
-        except KeyboardInterrupt:
-            pass
+        # The listening socket is only needed for a single client.
+        listener.close()
+
+        # Add data connection to server's registry of open connections.
+        add_data_connection(self)
+
+        # Set "connected" event.
+        self.connected.set()
+        log('Connected to passive data channel.', self)
+
+    def tune(self):
+        '''tune()
+        Set the options of the connected data socket, and cork it for the
+        transfer so data written in pieces, such as the batches of a listing,
+        leaves in full segments.'''
+
+        self.options.connected(self.conn)
+        if self.cork:
+            cork(self.conn, True)
+
+    def accept_timed_out(self):
+        '''accept_timed_out()
+        The client did not connect to the Passive Mode data connection in time.
+        The listening socket has been closed; wake anyone waiting to connect.
+        Does nothing if the data connection was closed first.'''
+
+        # Test if data connection was closed while the listener timed out.
+        if not self.take_listener():
+            return
+
+        log('Timed out waiting for passive data connection.', self)
+        server.timed_out('passive_accept')
+
+        # The port is free again as soon as its listening socket is closed.
+        self.release_port()
+        self.connected.set()
+
+    def take_listener(self):
+        '''take_listener() -> listening socket or None
+        Stop using the Passive Mode listening socket and return it, so exactly
+        one thread closes it. Returns None if it was already taken.'''
+
+        with self.lock:
+            listener = self.listener
+            self.listener = None
+
+        return listener
+
+    def release_port(self):
+        '''release_port()
+        Return the passive port to the server's pool, at most once.'''
+
+        with self.lock:
+            port = self.reserved_port
+            self.reserved_port = None
+
+        if port:
+            server.ports.release(port)
 
     def addr_info(self):
         '''addr_info()
@@ -785,65 +1939,337 @@ class DataConnection:
         return f'{self.addr}:{self.port}'
 
     def sendall(self, msg):
-        '''sendall(msg)
+        '''sendall(msg) -> number of bytes sent
         Send all data to client over data connection.'''
 
-        self.conn.sendall(System.encode(msg))
+        data = System.encode(msg)
+        self.send_raw(data)
+        return len(data)
 
-    def recvall(self, bufsize=4096):
-        '''recvall(bufsize=4096) -> response data
-        Receive, decode, and return all response data over data connection.'''
+    def send_raw(self, data):
+        '''send_raw(data)
+        Send data as is, once the download rate limit allows it.'''
 
-        data = b''
-        while True:
-            # Receive some data.
-            res = self.conn.recv(bufsize)
-            print(f'received {len(res)} bytes')
-            data += res
+        if self.download:
+            self.download.throttle(len(data))
 
-            # Test if end of message.
-            if len(res) < bufsize:
-                break
+        self.conn.sendall(data)
+
+    def ls(self, path, names_only=False):
+        '''ls(path, names_only=False) -> number of bytes sent
+        Send directory list information to client. A cached listing is sent if
+        the directory has not changed since it was cached; otherwise lines are
+        sent in batches of about one buffer as the directory is read, and the
+        listing is cached if it is small enough.'''
+
+        cache = server.listings
+        key = ListingCache.key(path, names_only)
+        validator = cache.validator(path)
+        listing = cache.get(key, validator) if validator else None
 
-        return System.decode(data)
+        self.begin()
 
-    def ls(self, path):
-        '''ls(path)
-        Send directory list information to client.'''
+        # Test if a valid listing is cached.
+        if listing is not None:
+            self.send(listing)
+            nbytes = len(listing)
 
-        # Get list information.
-        file_list = File.listdir(path)
+        else:
+            # Get list information.
+            if names_only:
+                lines = File.namelist(path)
+            else:
+                lines = File.listdir(path)
+
+            # Send to client, keeping a copy to cache.
+            keep_limit = cache.max_entry if validator else 0
+            nbytes, listing = self.send_lines(lines, keep_limit)
 
-        # Send to client.
-        self.sendall(file_list)
+            # Cache listing unless the directory changed while it was read.
+            if listing is not None and cache.validator(path) == validator:
+                cache.put(key, validator, listing)
+
+        self.finish()
+        server.open_connections.add_bytes(self.session_id, sent=nbytes)
         log(f'Sent LIST data to client.', self)
+        return nbytes
+
+    def send_lines(self, lines, keep_limit=0):
+        '''send_lines(lines, keep_limit=0) -> (number of bytes sent, data)
+        Send each line terminated by CRLF, batching lines into writes of about
+        one buffer. The data sent is also returned if it is no more than
+        keep_limit bytes; otherwise None is returned in its place.'''
+
+        batch = []
+        size = 0
+        kept = []
+        nbytes = 0
+        for line in lines:
+            batch.append(line)
+            size += len(line) + 2
+
+            # Test if batch is full.
+            if size >= self.bufsize:
+                data = self.send_batch(batch)
+                nbytes += len(data)
+                if nbytes <= keep_limit:
+                    kept.append(data)
+
+                batch = []
+                size = 0
+
+        # Send the rest of the lines.
+        if batch:
+            data = self.send_batch(batch)
+            nbytes += len(data)
+            if nbytes <= keep_limit:
+                kept.append(data)
+
+        # Test if too much was sent to keep.
+        if nbytes > keep_limit:
+            return nbytes, None
+
+        return nbytes, b''.join(kept)
+
+    def send_batch(self, batch):
+        '''send_batch(batch) -> data sent
+        Send a batch of lines, each terminated by CRLF.'''
+
+        batch.append('')
+        data = System.encode('\r\n'.join(batch))
+        self.send(data)
+        return data
+
+    def begin(self):
+        '''begin()
+        Start sending a stream of data. In MODE Z the data is compressed.'''
+
+        if self.deflate:
+            self.compressor = zlib.compressobj(self.level)
+
+    def send(self, data):
+        '''send(data)
+        Send data to client over data connection, compressing it first if the
+        transfer mode is Z.'''
+
+        # Test if data is compressed (MODE Z).
+        if self.compressor:
+            data = self.compressor.compress(data)
+
+        if data:
+            self.send_raw(data)
+
+    def finish(self):
+        '''finish()
+        Finish sending a stream of data, sending whatever the compressor still
+        holds.'''
+
+        if self.compressor:
+            self.send_raw(self.compressor.flush())
+            self.compressor = None
+
+    def stor(self, path, offset=0, append=False):
+        '''stor(path, offset=0, append=False) -> number of bytes stored
+        Retrieve file from client and store on file system. Data is received
+        into one preallocated buffer until the client closes the connection and
+        each chunk is written to the file as it arrives, so peak memory is a
+        single buffer per upload. If append then the data is added to the end
+        of the file; otherwise it is written from offset and the file is cut
+        off where the data ends. The caller must hold server.maps.writing() of
+        the path.'''
+
+        log(f'Storing file "{path}" from client at offset {offset}.', self)
+        buf = bytearray(self.bufsize)
+        view = memoryview(buf)
+        decompressor = zlib.decompressobj() if self.deflate else None
+        nbytes = 0
+        with File.open_write(path, offset, append) as f:
+            while True:
+                # Receive the next chunk into the buffer.
+                n = self.conn.recv_into(buf)
 
-    def stor(self, path):
-        '''stor(path)
-        Retrieve file from client and store on file system.'''
+                # Test if client finished sending.
+                if not n:
+                    break
 
-        # Receive all file data.
-        f_data = self.recvall(8192)
+                if self.upload:
+                    self.upload.throttle(n)
 
-        log(f'Storing file "{path}" from client.', self)
-        with open(path, 'w') as f:
-            f.write(f_data)
+                # Test if data is compressed (MODE Z).
+                if decompressor:
+                    nbytes += self.inflate(f, decompressor, view[:n])
+                else:
+                    f.write(view[:n])
+                    nbytes += n
+
+            if decompressor:
+                data = decompressor.flush()
+                f.write(data)
+                nbytes += len(data)
+
+            # Test if an old tail of the file is left past the new data.
+            if offset:
+                f.truncate()
+
+            # Test if data must reach the disk before replying.
+            if self.fsync_on_close:
+                File.sync(f)
+
+        # Listings of the directory now show a stale size.
+        server.listings.invalidate_dir(File.parent(path))
+        server.files.invalidate(path)
+        File.forget(path)
+
+        server.open_connections.add_bytes(self.session_id, received=nbytes)
+        log(f'Stored file "{path}" ({nbytes} bytes) from client OK.', self)
+        return nbytes
+
+    def inflate(self, f, decompressor, data):
+        '''inflate(f, decompressor, data) -> number of bytes written
+        Decompress data into the file at most one buffer at a time, so a small
+        amount of highly compressed data cannot use a lot of memory.'''
+
+        nbytes = 0
+        while data:
+            out = decompressor.decompress(data, self.bufsize)
+            f.write(out)
+            nbytes += len(out)
+            data = decompressor.unconsumed_tail
+
+        return nbytes
+
+    def retr(self, path, offset=0):
+        '''retr(path, offset=0) -> number of bytes sent
+        Send a file, from offset to its end, to the client over data connection.
+        Small files are sent from the file cache. Larger files are streamed
+        straight from their file descriptor to the data socket with sendfile
+        when the platform supports it, otherwise they are sent in fixed size
+        chunks from a memory map shared by all transfers of the file, so memory
+        use stays flat regardless of the size of the file or the offset. In
+        MODE Z the chunks are compressed.'''
+
+        log(f'Sending file "{path}" from offset {offset}.', self)
+        cache = server.files
+        validator = cache.validator(path)
+        data = cache.get(path, validator) if validator else None
+
+        # Test if file is small enough to be cached but is not yet.
+        if data is None and validator and validator[2] <= cache.max_entry:
+            data = self.read_file(path, validator)
+
+        if data is not None:
+            nbytes = self.send_buffer(data, offset)
+
+        # Test if zero-copy sendfile is available and data is sent as is.
+        elif File.zero_copy() and not self.deflate:
+            with File.open_read(path) as f:
+                nbytes = self.send_file(f, offset)
+
+        else:
+            nbytes = self.send_mapped(path, validator, offset)
 
-        log(f'Stored file "{path}" from client OK.', self)
+        server.open_connections.add_bytes(self.session_id, sent=nbytes)
+        log(f'Sent file "{path}" ({nbytes} bytes) to client over data connection.', self)
+        return nbytes
 
-    def retr(self, path):
-        '''retr(path)
-        Send a file to the client over data connection.'''
+    def read_file(self, path, validator):
+        '''read_file(path, validator) -> data of the file
+        Read a whole file and cache it unless it changed while being read.'''
 
-        # Read the file.
-        log(f'Reading file "{path}".', self)
-        with open(path, 'r') as f:
-            text = f.read()
+        size = validator[2]
+        data = bytearray(size)
+        with File.open_read(path) as f:
+            n = f.readinto(data) if size else 0
+
+        # Test if file is unchanged.
+        if n == size and server.files.validator(path) == validator:
+            server.files.put(path, validator, data)
+        else:
+            del data[n:]
 
-        log(f'Done reading file "{path}".', self)
+        return data
 
-        self.sendall(text)
-        log(f'Sent file "{path}" to client over data connection.', self)
+    def send_mapped(self, path, validator, offset):
+        '''send_mapped(path, validator, offset) -> number of bytes sent
+        Send a file from a memory map shared with the other transfers of it in
+        flight, or by reading it in chunks if it cannot be mapped. Worker
+        processes never map files: maps only keep uploads in the same process
+        from cutting a file short, and a map of a file cut short by another
+        process kills this one with SIGBUS.'''
+
+        m = None
+        if validator and not server.partition:
+            m = server.maps.acquire(path, validator)
+
+        # Test if file cannot be mapped.
+        if m is None:
+            with File.open_read(path) as f:
+                f.seek(offset)
+                self.begin()
+                nbytes = self.send_chunks(f)
+                self.finish()
+
+            return nbytes
+
+        try:
+            return self.send_buffer(m, offset)
+        finally:
+            server.maps.release(path, validator)
+
+    def send_file(self, f, offset=0):
+        '''send_file(f, offset=0) -> number of bytes sent
+        Send a file from offset with sendfile. While the download is rate
+        limited it is sent one buffer at a time, otherwise in pieces of
+        SENDFILE_CHUNK bytes so a limit set during the transfer applies soon.'''
+
+        total = 0
+        while True:
+            limited = self.download and self.download.limited()
+            count = self.bufsize if limited else SENDFILE_CHUNK
+            if limited:
+                self.download.throttle(count)
+
+            n = self.conn.sendfile(f, offset + total, count)
+            total += n
+
+            # Test if end of file.
+            if n < count:
+                return total
+
+    def send_buffer(self, data, offset=0):
+        '''send_buffer(data, offset=0) -> number of bytes sent
+        Send data, from offset to its end, to the client in chunks of one
+        buffer without copying it.'''
+
+        self.begin()
+        with memoryview(data) as view:
+            for i in range(offset, len(view), self.bufsize):
+                with view[i:i + self.bufsize] as chunk:
+                    self.send(chunk)
+
+        self.finish()
+        return max(0, len(data) - offset)
+
+    def send_chunks(self, f):
+        '''send_chunks(f) -> number of bytes sent
+        Send the contents of a binary file object to the client by reading it
+        into a single reusable buffer.'''
+
+        buf = bytearray(self.bufsize)
+        view = memoryview(buf)
+        total = 0
+        while True:
+            # Read the next chunk into the buffer.
+            n = f.readinto(buf)
+
+            # Test if end of file.
+            if not n:
+                break
+
+            self.send(view[:n])
+            total += n
+
+        return total
 
 
 class State:
@@ -854,7 +2280,18 @@ class State:
 
     def get_reply(self):
         '''get_reply()
-        Generates a reply to send to a client based on current state.'''
+        Generates a reply to send to a client based on current state. If the
+        message is a list of lines then a multi-line reply is generated.'''
+
+        # Test if reply spans multiple lines.
+        if isinstance(self.message, list) and len(self.message) > 1:
+            lines = [f'{self.code}-{self.message[0]}']
+            lines += [f' {line}' for line in self.message[1:-1]]
+            lines.append(f'{self.code} {self.message[-1]}')
+            return '\r\n'.join(lines) + '\r\n'
+
+        elif isinstance(self.message, list):
+            return f'{self.code} {self.message[0]}\r\n'
 
         return f'{self.code} {self.message}\r\n'
 
@@ -867,15 +2304,56 @@ class State:
 
 
 if __name__ == '__main__':
-    # Get command line args.
-    # filename, port = System.args(PORT_MIN, PORT_MAX)
-    filename, port = 'mylog.txt', 2121
-
     config = System.config()
-    if config.all_data_conn_types_disabled():
-        System.exit(
-            'Fatal error: server config file disables both PORT and PASV.')
+    error = config.error(PORT_MIN, PORT_MAX)
+    if error:
+        System.exit(f'Fatal error: {error}')
+
+    filename, port = config.log_file, config.listen_port
+
+    # Test if number of workers is given on the command line.
+    workers = System.workers() or config.workers
+    if workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+            System.exit(
+                'Fatal error: worker processes need fork and SO_REUSEPORT.')
+
+        if config.pasv_max_port - config.pasv_min_port + 1 < workers:
+            System.exit(
+                'Fatal error: passive port range is smaller than the number of workers.')
+
+    # Shut down on SIGTERM the same way as on Ctrl-C so no log lines are lost.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # Test if server runs as several worker processes sharing the port.
+    if workers > 1:
+        logger = open_log(filename, config)
+
+        # The supervisor writes the log file, so it applies the log settings
+        # of a reloaded config file that has no errors.
+        def reload():
+            config = System.config()
+            error = config.error(PORT_MIN, PORT_MAX)
+            if error:
+                logger.write(f'supervisor: Config file not reloaded: {error}')
+            else:
+                configure_log(logger, config)
+
+        supervisor = Supervisor(
+            workers, config, logger,
+            lambda config, logger: create_server(
+                filename, port, config, logger, reuse_port=True),
+            reload)
+
+        # Reload the config file here and in every worker on SIGHUP.
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: supervisor.hangup())
+        supervisor.start()
 
     # Initialize server object and run main processing loop.
-    server = Server(filename, port, config)
-    server.start()
+    else:
+        create_server(filename, port, config)
+
+        # Reload the config file on SIGHUP.
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.request_reload())
+        server.start()
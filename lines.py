@@ -0,0 +1,69 @@
+# CS472 - Homework #4
+# Edward Parrish
+# lines.py
+#
+# This module is the line buffer module of the FTP server. It contains the
+# LineBuffer class which the major module uses to split the bytes received
+# over a control connection into command lines.
+
+# Returned by LineBuffer.next_line() in place of a line that is too long.
+TOO_LONG = object()
+
+
+class LineBuffer:
+    '''LineBuffer
+    Buffers the bytes received over a control connection and splits them into
+    lines ending with CRLF (a bare LF is also accepted). Bytes may arrive in
+    any pieces: several pipelined commands in one piece are returned one at a
+    time and a command split across pieces is returned once it is complete.
+    A line longer than max_line bytes is discarded and reported as TOO_LONG,
+    so a client cannot make the buffer grow without bound.'''
+
+    def __init__(self, max_line=4096):
+        self.max_line = max_line
+        self.data = bytearray()
+        self.discarding = False
+
+    def __len__(self):
+        return len(self.data)
+
+    def feed(self, data):
+        '''feed(data)
+        Add received bytes to the buffer.'''
+
+        self.data += data
+
+    def next_line(self):
+        '''next_line() -> line, TOO_LONG, or None
+        Remove and return the next complete line, including its line ending.
+        Returns None if no complete line has been received yet.'''
+
+        while True:
+            i = self.data.find(b'\n')
+
+            # Test if rest of a line that is too long is being thrown away.
+            if self.discarding:
+                if i < 0:
+                    self.data.clear()
+                    return None
+
+                del self.data[:i + 1]
+                self.discarding = False
+                continue
+
+            # Test if line is not complete yet.
+            if i < 0:
+                if len(self.data) > self.max_line:
+                    self.data.clear()
+                    self.discarding = True
+                    return TOO_LONG
+
+                return None
+
+            line = bytes(self.data[:i + 1])
+            del self.data[:i + 1]
+
+            if len(line) > self.max_line:
+                return TOO_LONG
+
+            return line
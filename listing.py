@@ -0,0 +1,129 @@
+# CS472 - Homework #4
+# Edward Parrish
+# listing.py
+#
+# This module is the listing module of the FTP server. It contains the Lister
+# class which the utility module uses to produce directory listings without
+# running an external "ls" process.
+
+import os
+import stat
+import time
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    # Not available on every platform; numeric ids are listed instead.
+    grp = None
+    pwd = None
+
+
+class Lister:
+    '''Lister
+    Produces "ls -l" style listing lines one entry at a time with os.scandir,
+    so a listing can be sent while the directory is still being read and its
+    memory use does not grow with the size of the directory. Like "ls -A" the
+    "." and ".." entries are left out; unlike "ls" entries are not sorted.'''
+
+    SIX_MONTHS = 182 * 24 * 60 * 60
+
+    def __init__(self):
+        self.users = {}
+        self.groups = {}
+
+    def user(self, uid):
+        '''user(uid) -> user name
+        Return the name of a user id, caching the lookup.'''
+
+        name = self.users.get(uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except (AttributeError, KeyError):
+                name = str(uid)
+
+            self.users[uid] = name
+
+        return name
+
+    def group(self, gid):
+        '''group(gid) -> group name
+        Return the name of a group id, caching the lookup.'''
+
+        name = self.groups.get(gid)
+        if name is None:
+            try:
+                name = grp.getgrgid(gid).gr_name
+            except (AttributeError, KeyError):
+                name = str(gid)
+
+            self.groups[gid] = name
+
+        return name
+
+    def date(self, mtime, now):
+        '''date(mtime, now) -> formatted modification date
+        Format a modification time like "ls": the time of day for files changed
+        in the last six months, otherwise the year.'''
+
+        t = time.localtime(mtime)
+        day = time.strftime('%b', t) + f' {t.tm_mday:2d}'
+
+        # Test if modified in the last six months.
+        if now - Lister.SIX_MONTHS < mtime <= now + 60:
+            return f'{day} {t.tm_hour:02d}:{t.tm_min:02d}'
+
+        return f'{day}  {t.tm_year}'
+
+    def line(self, path, name, st, now):
+        '''line(path, name, st, now) -> listing line
+        Format the stat result st of entry name at path as an "ls -l" line.'''
+
+        # Test if entry is a symbolic link.
+        if stat.S_ISLNK(st.st_mode):
+            try:
+                name = f'{name} -> {os.readlink(path)}'
+            except OSError:
+                pass
+
+        return (f'{stat.filemode(st.st_mode)} {st.st_nlink:4d} '
+                f'{self.user(st.st_uid):<8} {self.group(st.st_gid):<8} '
+                f'{st.st_size:12d} {self.date(st.st_mtime, now)} {name}')
+
+    def list_lines(self, path):
+        '''list_lines(path) -> generator of listing lines
+        Generate an "ls -l" line for each entry in the directory at path, or a
+        single line if path is not a directory.'''
+
+        now = time.time()
+
+        # Test if path is not a directory.
+        if not os.path.isdir(path):
+            st = os.lstat(path)
+            yield self.line(path, os.path.basename(path), st, now)
+            return
+
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    # Entry was removed while listing.
+                    continue
+
+                yield self.line(entry.path, entry.name, st, now)
+
+    def name_lines(self, path):
+        '''name_lines(path) -> generator of names
+        Generate the name of each entry in the directory at path, or the name
+        of path itself if it is not a directory.'''
+
+        # Test if path is not a directory.
+        if not os.path.isdir(path):
+            yield os.path.basename(path)
+            return
+
+        with os.scandir(path) as it:
+            for entry in it:
+                yield entry.name
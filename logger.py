@@ -5,40 +5,270 @@
 # This module is the logger module of the FTP server. It contains the Logger
 # class which is used by the major module.
 
+import atexit
 import datetime
+import glob
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
 
 
 class Logger:
     '''Logger
-    The Logger helper class. Used to write logs to a file.'''
+    The Logger helper class. Used to write logs to a file. Lines are queued by
+    write() and written by a background thread which keeps the log file open,
+    flushes it in batches, and rotates it by size and/or age.'''
 
     LINE_SEP = '\n'
+    ENCODING = 'utf-8'
+    STOP = None
 
-    def __init__(self, filename):
+    def __init__(self, filename, flush_lines=256, flush_interval=1.0,
+                 max_bytes=0, rotate_interval=0, backups=5, compress=False):
         self.filename = filename
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.compress = compress
 
-    def timestamp(self):
-        '''timestamp() - > formatted timestamp
-        Return a formatted timestamp string of the current datetime.'''
+        self.file = None
+        self.size = 0
+        self.next_rotation = 0
+        self.second = None
+        self.prefix = ''
+        self.compressors = []
+        self.queue = queue.SimpleQueue()
+        self.closed = False
 
-        return datetime.datetime.now().strftime('%x %X.%f')
+        self.thread = threading.Thread(
+            target=self.run, name='logger', daemon=True)
+        self.thread.start()
+
+        # Make sure queued lines are written when the interpreter exits.
+        atexit.register(self.close)
+
+    def timestamp(self, t):
+        '''timestamp(t) - > formatted timestamp
+        Return a formatted timestamp string of the epoch time t. The date and
+        time part only changes once a second so it is cached.'''
+
+        second = int(t)
+
+        # Test if second changed since last timestamp.
+        if second != self.second:
+            self.second = second
+            self.prefix = datetime.datetime.fromtimestamp(
+                second).strftime('%x %X')
+
+        return f'{self.prefix}.{int((t - second) * 1e6):06d}'
 
     def write(self, description):
         '''write(description)
-        Write to log file. If the log file's filename has been lost then print
-        to the console.'''
+        Queue a line to be written to the log file. Returns immediately; the
+        line is timestamped and written by the background thread.'''
+
+        self.queue.put((time.time(), description))
 
-        line = f'{self.timestamp()} {description}{self.LINE_SEP}'
+    def write_lines(self, text):
+        '''write_lines(text)
+        Queue lines that are already timestamped and terminated, such as the
+        lines logged by another process, to be written as they are.'''
 
-        # Test if filename is defined.
-        if self.filename:
+        self.queue.put((None, text))
+
+    def run(self):
+        '''run()
+        The main loop of the background thread. Takes queued lines in batches,
+        writes them, and flushes the file once flush_lines lines are pending
+        or flush_interval seconds have passed.'''
+
+        pending = 0
+        deadline = time.monotonic() + self.flush_interval
+        stopping = False
+        while not stopping:
+            # Wait for a line until the next flush is due.
+            timeout = max(0, deadline - time.monotonic())
             try:
-                with open(self.filename, 'a') as log_file:
-                    # Append the line to log file.
-                    log_file.write(line)
+                items = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                items = []
+
+            # Take whatever else is already queued without waiting.
+            while len(items) < self.flush_lines:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for item in items:
+                if item is Logger.STOP:
+                    stopping = True
+                else:
+                    lines.append(self.format(*item))
+
+            if lines:
+                self.emit(''.join(lines))
+                pending += len(lines)
+
+            # Test if a flush is due.
+            now = time.monotonic()
+            if stopping or pending >= self.flush_lines or now >= deadline:
+                self.flush()
+                pending = 0
+                deadline = now + self.flush_interval
+
+        # Write anything that was queued after close().
+        lines = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not Logger.STOP:
+                lines.append(self.format(*item))
+
+        if lines:
+            self.emit(''.join(lines))
+
+        self.flush()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def format(self, t, description):
+        '''format(t, description) -> log line'''
+
+        # Test if lines are already formatted.
+        if t is None:
+            return description
+
+        return f'{self.timestamp(t)} {description}{self.LINE_SEP}'
+
+    def emit(self, text):
+        '''emit(text)
+        Write text to the log file, rotating it first if it is due. If the log
+        file's filename has been lost then print to the console.'''
+
+        # Test if filename is not defined.
+        if not self.filename:
+            print(text, end='')
+            return
+
+        data = text.encode(Logger.ENCODING)
+        try:
+            # Test if log file is due to be rotated.
+            if self.rotation_due(len(data)):
+                self.rotate()
+
+            # Test if log file is not open.
+            if not self.file:
+                self.open()
+
+            self.file.write(data)
+            self.size += len(data)
 
-            except Exception as err:
+        except Exception as err:
+            print(f'Error writing to log file {self.filename}: {err}')
+            print(text, end='')
+            self.file = None
+
+    def flush(self):
+        '''flush()
+        Flush the log file's buffer to the operating system.'''
+
+        if self.file:
+            try:
+                self.file.flush()
+            except OSError as err:
                 print(f'Error writing to log file {self.filename}: {err}')
-                print(line)
-        else:
-            print(line)
+
+    def open(self):
+        '''open()
+        Open the log file for appending and keep it open.'''
+
+        self.file = open(self.filename, 'ab')
+        self.size = self.file.tell()
+        if self.rotate_interval:
+            self.next_rotation = time.time() + self.rotate_interval
+
+    def rotation_due(self, nbytes):
+        '''rotation_due(nbytes) -> boolean
+        Test if writing nbytes more bytes should first rotate the log file.'''
+
+        # Test if file is not open or is empty.
+        if not self.file or not self.size:
+            return False
+
+        if self.max_bytes and self.size + nbytes > self.max_bytes:
+            return True
+
+        if self.rotate_interval and time.time() >= self.next_rotation:
+            return True
+
+        return False
+
+    def rotate(self):
+        '''rotate()
+        Close the log file and rename it with a timestamp suffix. The rotated
+        file is compressed in the background if compress is set, and the
+        oldest rotated files beyond the number of backups are removed.'''
+
+        self.file.close()
+        self.file = None
+
+        suffix = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        rotated = f'{self.filename}.{suffix}'
+        os.rename(self.filename, rotated)
+
+        if self.compress:
+            t = threading.Thread(
+                target=self.compress_file, args=(rotated,), daemon=True)
+            t.start()
+            self.compressors = [c for c in self.compressors if c.is_alive()]
+            self.compressors.append(t)
+
+        self.remove_old_backups()
+
+    def compress_file(self, path):
+        '''compress_file(path)
+        Gzip a rotated log file and remove the original.'''
+
+        try:
+            with open(path, 'rb') as src, gzip.open(f'{path}.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(path)
+        except OSError as err:
+            print(f'Error compressing log file {path}: {err}')
+
+    def remove_old_backups(self):
+        '''remove_old_backups()
+        Remove the oldest rotated log files beyond the number of backups.'''
+
+        # Rotated names sort by time; a file and its .gz count once.
+        backups = {}
+        for path in glob.glob(f'{glob.escape(self.filename)}.*'):
+            backups.setdefault(path.removesuffix('.gz'), []).append(path)
+
+        for name in sorted(backups)[:-self.backups or None]:
+            for path in backups[name]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def close(self):
+        '''close()
+        Write every queued line, close the log file, and wait for background
+        compression to finish. Safe to call more than once.'''
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.queue.put(Logger.STOP)
+        self.thread.join()
+        for t in self.compressors:
+            t.join()
@@ -0,0 +1,272 @@
+# CS472 - Homework #4
+# Edward Parrish
+# metrics.py
+#
+# This module is the metrics module of the FTP server. It contains the Metrics
+# class which the major module uses to count what the server does, and the
+# MetricsExporter class which serves those counts to Prometheus over HTTP.
+
+import bisect
+import http.server
+import threading
+
+# Upper bounds of the histogram buckets of transfer durations in seconds,
+# transfer rates in bytes per second, and command latencies in seconds.
+DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+RATE_BUCKETS = (1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Quantiles shown in the summary of each histogram.
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    '''Histogram
+    Counts observed values in buckets with fixed upper bounds, along with the
+    number and sum of all observed values.'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        '''observe(value)
+        Count value in the first bucket whose upper bound is not less than it.'''
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        '''cumulative() -> list of (upper bound, count of values <= bound)'''
+
+        bounds = [str(b) for b in self.buckets] + ['+Inf']
+        total = 0
+        result = []
+        for bound, n in zip(bounds, self.counts):
+            total += n
+            result.append((bound, total))
+
+        return result
+
+    def quantile(self, q):
+        '''quantile(q) -> estimate of the q-quantile of the observed values
+        Find the bucket holding the q-quantile and interpolate linearly within
+        it. Values in the last, unbounded bucket are estimated as the largest
+        bound.'''
+
+        if not self.count:
+            return 0
+
+        rank = q * self.count
+        lower = 0
+        total = 0
+        for upper, n in zip(self.buckets, self.counts):
+            # Test if quantile is in this bucket.
+            if n and total + n >= rank:
+                return lower + (upper - lower) * (rank - total) / n
+
+            total += n
+            lower = upper
+
+        return self.buckets[-1]
+
+
+class Metrics:
+    '''Metrics
+    Thread safe counters and histograms, each identified by a name and a set
+    of labels, rendered in the Prometheus text exposition format. The live
+    values returned by the gauges function are rendered as gauges.'''
+
+    def __init__(self, prefix='ftp', gauges=None):
+        self.prefix = prefix
+        self.gauges = gauges
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        '''key(name, labels) -> key of a counter or histogram'''
+
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        '''inc(name, value=1, **labels)
+        Add value to a counter.'''
+
+        key = Metrics.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets, **labels):
+        '''observe(name, value, buckets, **labels)
+        Count value in a histogram, creating it with buckets if needed.'''
+
+        key = Metrics.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if not histogram:
+                histogram = self.histograms[key] = Histogram(buckets)
+
+            histogram.observe(value)
+
+    def name(self, name, labels=(), extra=()):
+        '''name(name, labels=(), extra=()) -> Prometheus sample name'''
+
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return f'{self.prefix}_{name}'
+
+        text = ','.join(f'{k}="{v}"' for k, v in pairs)
+        return f'{self.prefix}_{name}{{{text}}}'
+
+    def render(self):
+        '''render() -> metrics in the Prometheus text exposition format'''
+
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            # Each metric's type is declared once, before its first sample.
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                declare(name, 'counter')
+                lines.append(f'{self.name(name, labels)} {value}')
+
+            for (name, labels), h in sorted(self.histograms.items()):
+                declare(name, 'histogram')
+                for bound, n in h.cumulative():
+                    sample = self.name(f'{name}_bucket', labels, [('le', bound)])
+                    lines.append(f'{sample} {n}')
+
+                lines.append(f'{self.name(name + "_sum", labels)} {h.sum}')
+                lines.append(f'{self.name(name + "_count", labels)} {h.count}')
+
+        if self.gauges:
+            for name, value in self.gauges().items():
+                declare(name, 'gauge')
+                lines.append(f'{self.name(name)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''summary() -> list of lines
+        Summarize the metrics in a few readable lines: each counter, and the
+        number, mean, and quantiles of the values of each histogram.'''
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{self.name(name, labels)}: {value}')
+
+            for (name, labels), h in sorted(self.histograms.items()):
+                mean = h.sum / h.count if h.count else 0
+                text = f'count={h.count} mean={mean:.6g}'
+                for q in QUANTILES:
+                    text += f' p{round(q * 100)}={h.quantile(q):.6g}'
+
+                lines.append(f'{self.name(name, labels)}: {text}')
+
+        return lines
+
+    def snapshot(self):
+        '''snapshot() -> dictionary of the current values
+        Return the counters, histograms, and gauges in a form that can be sent
+        to another process as JSON and added to its metrics with load().'''
+
+        with self.lock:
+            counters = [[name, labels, value]
+                        for (name, labels), value in self.counters.items()]
+            histograms = [[name, labels, h.buckets, h.counts, h.count, h.sum]
+                          for (name, labels), h in self.histograms.items()]
+
+        gauges = self.gauges() if self.gauges else {}
+        return {'counters': counters, 'histograms': histograms,
+                'gauges': gauges}
+
+    def load(self, snapshot):
+        '''load(snapshot)
+        Add the counters and histograms of a snapshot to these metrics.'''
+
+        with self.lock:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+
+            for name, labels, buckets, counts, count, total in \
+                    snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                histogram = self.histograms.get(key)
+                if not histogram:
+                    histogram = Histogram(tuple(buckets))
+                    self.histograms[key] = histogram
+
+                for i, n in enumerate(counts):
+                    histogram.counts[i] += n
+
+                histogram.count += count
+                histogram.sum += total
+
+    def quantiles(self, name):
+        '''quantiles(name) -> dictionary of labels to quantile estimates
+        Return the count and the estimated quantiles of each histogram named
+        name, keyed by its labels.'''
+
+        result = {}
+        with self.lock:
+            for (n, labels), h in self.histograms.items():
+                if n == name:
+                    result[labels] = {'count': h.count}
+                    for q in QUANTILES:
+                        result[labels][f'p{round(q * 100)}'] = h.quantile(q)
+
+        return result
+
+
+class MetricsExporter:
+    '''MetricsExporter
+    Serves the metrics at http://127.0.0.1:port/metrics from a side thread so a
+    Prometheus server on the same host can scrape them.'''
+
+    def __init__(self, metrics, port):
+        self.metrics = metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                # Test if path is not the metrics page.
+                if handler.path != '/metrics':
+                    handler.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                handler.send_response(200)
+                handler.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                # Scrapes are not worth a line in the log.
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        '''close()
+        Stop serving the metrics.'''
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
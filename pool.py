@@ -0,0 +1,78 @@
+# CS472 - Homework #4
+# Edward Parrish
+# pool.py
+#
+# This module is the worker pool module of the FTP server. It contains the
+# WorkerPool class which is used by the major module to serve clients with a
+# fixed number of threads.
+
+import queue
+import threading
+import traceback
+
+
+class WorkerPool:
+    '''WorkerPool
+    A fixed number of worker threads that run submitted tasks in the order they
+    were submitted. Tasks wait in a queue while all workers are busy.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.threads = []
+
+        for i in range(size):
+            t = threading.Thread(
+                target=self.work, name=f'worker-{i}', daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, fn, *args):
+        '''submit(fn, *args)
+        Queue fn to be called with args by the next free worker.'''
+
+        self.tasks.put((fn, args))
+
+    def queue_depth(self):
+        '''queue_depth() -> number of tasks waiting for a worker'''
+
+        return self.tasks.qsize()
+
+    def active_workers(self):
+        '''active_workers() -> number of workers running a task'''
+
+        with self.lock:
+            return self.active
+
+    def work(self):
+        '''work()
+        The main loop of a worker thread. Runs tasks until it receives None.'''
+
+        while True:
+            task = self.tasks.get()
+
+            # Test if pool is shutting down.
+            if task is None:
+                break
+
+            fn, args = task
+            with self.lock:
+                self.active += 1
+
+            try:
+                fn(*args)
+            except Exception:
+                # A failed task must not take its worker down with it.
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+    def shutdown(self):
+        '''shutdown()
+        Stop every worker once the tasks already queued have been run.'''
+
+        for _ in self.threads:
+            self.tasks.put(None)
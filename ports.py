@@ -0,0 +1,75 @@
+# CS472 - Homework #4
+# Edward Parrish
+# ports.py
+#
+# This module is the port pool module of the FTP server. It contains the
+# PortPool class which the major module uses to hand out the port numbers of
+# Passive Mode data connections.
+
+import collections
+import threading
+
+
+class PortPool:
+    '''PortPool
+    A thread safe pool of the port numbers in the range low to high inclusive.
+    Free ports are kept in a queue so a port is reserved and released in
+    constant time, and a port that was just released is the last to be reused.'''
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.free = collections.deque(range(low, high + 1))
+        self.reserved = set()
+        self.lock = threading.Lock()
+        self.exhausted = 0
+        self.peak = 0
+
+    def __len__(self):
+        return self.high - self.low + 1
+
+    def reserve(self):
+        '''reserve() -> port number or None
+        Reserve a free port. Returns None if every port is reserved.'''
+
+        with self.lock:
+            # Test if pool is exhausted.
+            if not self.free:
+                self.exhausted += 1
+                return None
+
+            port = self.free.popleft()
+            self.reserved.add(port)
+            self.peak = max(self.peak, len(self.reserved))
+            return port
+
+    def release(self, port):
+        '''release(port)
+        Return a reserved port to the pool. Does nothing if the port is not
+        reserved, so releasing a port twice is harmless.'''
+
+        with self.lock:
+            if port in self.reserved:
+                self.reserved.remove(port)
+
+                # Test if port is still in the range.
+                if self.low <= port <= self.high:
+                    self.free.append(port)
+
+    def resize(self, low, high):
+        '''resize(low, high)
+        Change the range of ports. Reserved ports stay reserved until they are
+        released; those outside the new range are then dropped.'''
+
+        with self.lock:
+            self.low = low
+            self.high = high
+            self.free = collections.deque(
+                p for p in range(low, high + 1) if p not in self.reserved)
+
+    def counters(self):
+        '''counters() -> dictionary of counter name to value'''
+
+        with self.lock:
+            return {'size': len(self), 'in_use': len(self.reserved),
+                    'peak_in_use': self.peak, 'exhausted': self.exhausted}
@@ -0,0 +1,368 @@
+# CS472 - Homework #4
+# Edward Parrish
+# prefork.py
+#
+# This module is the pre-fork module of the FTP server. It contains the
+# Supervisor class which runs the server as several worker processes that
+# share the control port with SO_REUSEPORT, and the Channel and PipeLogger
+# classes the workers use to send their log lines and metrics to it, so the
+# operator still sees one log file and one metrics page.
+
+import json
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+import traceback
+from logger import Logger
+from metrics import Metrics, MetricsExporter
+from util import ConfigWatcher
+
+
+class Channel:
+    '''Channel
+    The write end of a pipe from a worker process to the supervisor. Each
+    message is a frame of a one byte kind, a four byte length, and a payload,
+    so log lines spanning several lines and metrics stay in one piece.'''
+
+    LOG = b'L'
+    METRICS = b'M'
+    HEADER = struct.Struct('!cI')
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+
+    def send(self, kind, payload):
+        '''send(kind, payload)
+        Write one frame to the pipe. Frames from several threads are never
+        interleaved.'''
+
+        data = memoryview(Channel.HEADER.pack(kind, len(payload)) + payload)
+        with self.lock:
+            while data:
+                data = data[os.write(self.fd, data):]
+
+    @staticmethod
+    def frames(fd):
+        '''frames(fd) -> generator of (kind, payload)
+        Read frames from the read end of a pipe until the writer closes it.'''
+
+        buf = bytearray()
+        while True:
+            data = os.read(fd, 65536)
+
+            # Test if worker closed its end.
+            if not data:
+                return
+
+            buf += data
+            while len(buf) >= Channel.HEADER.size:
+                kind, n = Channel.HEADER.unpack_from(buf)
+                end = Channel.HEADER.size + n
+
+                # Test if frame is not complete yet.
+                if len(buf) < end:
+                    break
+
+                yield kind, bytes(buf[Channel.HEADER.size:end])
+                del buf[:end]
+
+
+class PipeLogger(Logger):
+    '''PipeLogger
+    The Logger of a worker process. Lines are queued and timestamped the same
+    way, but each batch is sent to the supervisor, which writes and rotates
+    the one log file.'''
+
+    def __init__(self, channel, flush_lines=256, flush_interval=1.0):
+        self.channel = channel
+        super().__init__(None, flush_lines, flush_interval)
+
+    def emit(self, text):
+        try:
+            self.channel.send(Channel.LOG, text.encode(Logger.ENCODING))
+        except OSError:
+            print(text, end='')
+
+    def flush(self):
+        pass
+
+
+class Worker:
+    '''Worker
+    The supervisor's record of one worker process.'''
+
+    def __init__(self, index, pid, fd):
+        self.index = index
+        self.pid = pid
+        self.fd = fd
+        self.started = time.monotonic()
+        self.snapshot = None
+        self.reader = None
+
+
+class Supervisor:
+    '''Supervisor
+    Forks the worker processes, restarts any that exit while the server is
+    running, and merges the log lines and metrics they send. create_server
+    is called in each worker with its config and logger and returns the
+    server to run. Each worker reloads its own config when the config file
+    changes; reload is called in the supervisor at the same times, so the
+    settings of the log file it writes change too.'''
+
+    # Seconds between metrics reports of a worker, and the shortest time
+    # between restarts of a worker that keeps crashing.
+    REPORT_INTERVAL = 1.0
+    RESTART_DELAY = 1.0
+
+    # Seconds workers are given to shut down before they are killed.
+    STOP_TIMEOUT = 10
+
+    def __init__(self, workers, config, logger, create_server, reload=None):
+        self.workers = workers
+        self.config = config
+        self.logger = logger
+        self.create_server = create_server
+        self.watcher = ConfigWatcher(reload) if reload else None
+        self.lock = threading.Lock()
+        self.running = {}
+        self.retired = Metrics()
+        self.stopping = False
+        self.exporter = None
+
+    def log(self, description):
+        self.logger.write(f'supervisor: {description}')
+
+    def start(self):
+        '''start()
+        Start the workers and supervise them until interrupted. Then stop the
+        workers and wait for them to exit.'''
+
+        # Test if metrics exporter is enabled.
+        if self.config.metrics_port:
+            self.exporter = MetricsExporter(self, self.config.metrics_port)
+            self.log(f'Serving metrics at 127.0.0.1:{self.config.metrics_port}.')
+
+        if self.watcher:
+            self.watcher.start()
+
+        try:
+            for index in range(self.workers):
+                self.spawn(index)
+
+            while True:
+                pid, status = os.wait()
+                self.reap(pid, status)
+
+        except KeyboardInterrupt:
+            self.stop()
+
+        finally:
+            if self.exporter:
+                self.exporter.close()
+
+            self.logger.close()
+
+    def spawn(self, index):
+        '''spawn(index)
+        Fork worker process index with one end of a new pipe to report on.'''
+
+        r, w = os.pipe()
+        pid = os.fork()
+
+        # Test if this is the worker process.
+        if pid == 0:
+            os.close(r)
+            for worker in self.running.values():
+                os.close(worker.fd)
+
+            self.run_worker(index, w)
+
+        os.close(w)
+        worker = Worker(index, pid, r)
+        worker.reader = threading.Thread(
+            target=self.read, args=(worker,), name=f'worker-{index}',
+            daemon=True)
+        with self.lock:
+            self.running[pid] = worker
+
+        worker.reader.start()
+        self.log(f'Started worker {index} (pid {pid}).')
+
+    def run_worker(self, index, fd):
+        '''run_worker(index, fd)
+        The body of a worker process. Runs a server until it is interrupted
+        and exits without returning, so the supervisor's state is never
+        unwound in the worker.'''
+
+        # Only the supervisor's SIGTERM stops a worker, not a Ctrl-C sent to
+        # the whole process group.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        code = 0
+        channel = Channel(fd)
+        logger = None
+        try:
+            config = self.config.for_worker(index, self.workers)
+            logger = PipeLogger(channel, config.log_flush_lines,
+                                config.log_flush_ms / 1000)
+            server = self.create_server(config, logger)
+            server.partition = (index, self.workers)
+
+            # Reload the config file when the supervisor passes on SIGHUP.
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: server.request_reload())
+
+            reporter = threading.Thread(
+                target=self.report, args=(server.metrics, channel),
+                name='reporter', daemon=True)
+            reporter.start()
+
+            server.start()
+            channel.send(Channel.METRICS,
+                         json.dumps(server.metrics.snapshot()).encode())
+
+        except KeyboardInterrupt:
+            pass
+
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+
+        finally:
+            if logger:
+                logger.close()
+
+            sys.stdout.flush()
+            os._exit(code)
+
+    def report(self, metrics, channel):
+        '''report(metrics, channel)
+        Send a snapshot of a worker's metrics to the supervisor every
+        REPORT_INTERVAL seconds.'''
+
+        while True:
+            time.sleep(Supervisor.REPORT_INTERVAL)
+            try:
+                channel.send(Channel.METRICS,
+                             json.dumps(metrics.snapshot()).encode())
+            except OSError:
+                return
+
+    def read(self, worker):
+        '''read(worker)
+        Write the log lines a worker sends to the log file and keep its latest
+        metrics snapshot, until the worker exits.'''
+
+        try:
+            for kind, payload in Channel.frames(worker.fd):
+                if kind == Channel.LOG:
+                    self.logger.write_lines(payload.decode(Logger.ENCODING))
+                elif kind == Channel.METRICS:
+                    worker.snapshot = json.loads(payload)
+        finally:
+            os.close(worker.fd)
+
+    def reap(self, pid, status):
+        '''reap(pid, status)
+        Forget a worker that exited, keeping its final counts, and start a new
+        one in its place unless the server is stopping.'''
+
+        with self.lock:
+            worker = self.running.pop(pid, None)
+
+        # Test if pid is not a worker.
+        if not worker:
+            return
+
+        # Wait for its last frames so none of its counts are lost.
+        worker.reader.join()
+        if worker.snapshot:
+            self.retired.load(worker.snapshot)
+
+        code = os.waitstatus_to_exitcode(status)
+        self.log(f'Worker {worker.index} (pid {pid}) exited with status {code}.')
+
+        # Test if server is stopping.
+        if self.stopping:
+            return
+
+        # Test if worker crashed soon after it started.
+        elapsed = time.monotonic() - worker.started
+        if elapsed < Supervisor.RESTART_DELAY:
+            time.sleep(Supervisor.RESTART_DELAY - elapsed)
+
+        self.spawn(worker.index)
+
+    def hangup(self):
+        '''hangup()
+        Reload the config file in the supervisor and pass SIGHUP on to every
+        worker so each reloads it too. Safe to call from a signal handler.'''
+
+        if self.watcher:
+            self.watcher.request()
+
+        # The handler runs on the main thread, which may hold the lock.
+        pids = list(self.running)
+
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def stop(self):
+        '''stop()
+        Ask every worker to shut down, and kill any that have not exited after
+        STOP_TIMEOUT seconds.'''
+
+        self.stopping = True
+        self.log('Stopping workers.')
+        with self.lock:
+            pids = list(self.running)
+
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + Supervisor.STOP_TIMEOUT
+        while self.running:
+            for pid in list(self.running):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    self.reap(pid, status)
+
+            # Test if workers are taking too long.
+            if self.running and time.monotonic() >= deadline:
+                for pid in list(self.running):
+                    os.kill(pid, signal.SIGKILL)
+
+                deadline = float('inf')
+
+            time.sleep(0.05)
+
+    def render(self):
+        '''render() -> metrics of all workers in the Prometheus text format
+        Counters and histograms are summed over the running workers and all
+        workers that have exited, so they never go backwards. Gauges are summed
+        over the running workers.'''
+
+        with self.lock:
+            snapshots = [w.snapshot for w in self.running.values() if w.snapshot]
+            workers = len(self.running)
+
+        gauges = {'workers': workers}
+        metrics = Metrics(gauges=lambda: gauges)
+        metrics.load(self.retired.snapshot())
+        for snapshot in snapshots:
+            metrics.load(snapshot)
+            for name, value in snapshot['gauges'].items():
+                gauges[name] = gauges.get(name, 0) + value
+
+        return metrics.render()
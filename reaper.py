@@ -0,0 +1,78 @@
+# CS472 - Homework #4
+# Edward Parrish
+# reaper.py
+#
+# This module is the reaper module of the FTP server. It contains the Reaper
+# class which the major module uses to end sessions that have been idle for
+# too long and to report what the server's timeouts have reclaimed.
+
+import collections
+import threading
+import time
+
+
+class Reaper:
+    '''Reaper
+    A thread that wakes every interval seconds. A session's own thread times
+    it out while waiting for a command, so the reaper only expires sessions
+    that have been idle for idle_timeout plus a whole interval, such as ones
+    still queued for a worker or ones sending a command a byte at a time.
+    Every timeout, including these, is counted with count(), and each time
+    the reaper wakes it logs what was reclaimed since it last woke.'''
+
+    def __init__(self, interval, idle_timeout, sessions, log):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.sessions = sessions
+        self.log = log
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name='reaper', daemon=True)
+        self.thread.start()
+
+    def count(self, kind):
+        '''count(kind)
+        Count a timeout of kind, such as "idle" or "data_stall".'''
+
+        with self.lock:
+            self.counts[kind] += 1
+
+    def run(self):
+        '''run()
+        The main loop of the reaper's thread.'''
+
+        while not self.stopped.wait(self.interval):
+            self.reap()
+
+    def reap(self):
+        '''reap()
+        Expire the sessions idle for too long and log what was reclaimed.'''
+
+        # Test if idle timeout is on.
+        if self.idle_timeout:
+            cutoff = time.monotonic() - self.idle_timeout - self.interval
+            for client in self.sessions():
+                idle_since = client.idle_since
+
+                # Test if session has been idle since before the cutoff and
+                # has not been expired already.
+                if idle_since is not None and idle_since < cutoff and \
+                        not client.timed_out:
+                    client.expire()
+
+        with self.lock:
+            counts = self.counts
+            self.counts = collections.Counter()
+
+        # Test if anything was reclaimed.
+        if counts:
+            text = ', '.join(f'{n} {kind}' for kind, n in sorted(counts.items()))
+            self.log(f'Timeouts in the last {self.interval} seconds: {text}.')
+
+    def close(self):
+        '''close()
+        Stop the reaper's thread.'''
+
+        self.stopped.set()
@@ -0,0 +1,141 @@
+# CS472 - Homework #4
+# Edward Parrish
+# registry.py
+#
+# This module is the registry module of the FTP server. It contains the
+# Registry class which the major module uses to keep track of open control and
+# data connections and of the metadata of each client session.
+
+import itertools
+import threading
+import time
+
+
+class Session:
+    '''Session
+    The metadata of a client session.'''
+
+    def __init__(self, session_id, addr):
+        self.session_id = session_id
+        self.addr = addr
+        self.user = ''
+        self.cwd = ''
+        self.connected = time.time()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def info(self):
+        '''info() -> dictionary of the session metadata'''
+
+        return dict(vars(self))
+
+
+class Registry:
+    '''Registry
+    A thread safe registry of open connections keyed by session id. Control
+    and data connections are kept separately so a session's data connection
+    can be found, added, and removed in constant time.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.control = {}
+        self.data = {}
+        self.sessions = {}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.control)
+
+    def __contains__(self, conn):
+        with self.lock:
+            return self.control.get(conn.session_id) is conn
+
+    def add_control(self, conn):
+        '''add_control(conn)
+        Add a control connection, giving it a new session id if it does not
+        already have one.'''
+
+        with self.lock:
+            if conn.session_id is None:
+                conn.session_id = next(self.ids)
+
+            if conn.session_id not in self.control:
+                self.control[conn.session_id] = conn
+                self.sessions[conn.session_id] = Session(
+                    conn.session_id, conn.addr_info())
+
+    def remove_control(self, conn):
+        '''remove_control(conn)
+        Remove a control connection and its session. Does nothing if it has
+        already been removed.'''
+
+        with self.lock:
+            if self.control.get(conn.session_id) is conn:
+                del self.control[conn.session_id]
+                self.sessions.pop(conn.session_id, None)
+
+    def add_data(self, data_conn):
+        '''add_data(data_conn)
+        Add the data connection of a session.'''
+
+        with self.lock:
+            self.data[data_conn.session_id] = data_conn
+
+    def remove_data(self, data_conn):
+        '''remove_data(data_conn)
+        Remove the data connection of a session. Does nothing if the session's
+        data connection has since been replaced.'''
+
+        with self.lock:
+            if self.data.get(data_conn.session_id) is data_conn:
+                del self.data[data_conn.session_id]
+
+    def update(self, session_id, **fields):
+        '''update(session_id, **fields)
+        Set metadata fields such as user and cwd of a session.'''
+
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session:
+                for name, value in fields.items():
+                    setattr(session, name, value)
+
+    def add_bytes(self, session_id, sent=0, received=0):
+        '''add_bytes(session_id, sent=0, received=0)
+        Count bytes moved over a session's data connections.'''
+
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session:
+                session.bytes_sent += sent
+                session.bytes_received += received
+
+    def snapshot(self):
+        '''snapshot() -> list of control connections
+        Return the open control connections at this moment. The list can be
+        iterated safely while connections are added and removed.'''
+
+        with self.lock:
+            return list(self.control.values())
+
+    def session_info(self):
+        '''session_info() -> list of dictionaries of session metadata'''
+
+        with self.lock:
+            return [s.info() for s in self.sessions.values()]
+
+    def data_count(self):
+        '''data_count() -> number of open data connections'''
+
+        with self.lock:
+            return len(self.data)
+
+    def clear(self):
+        '''clear()
+        Remove every connection and session.'''
+
+        with self.lock:
+            self.control.clear()
+            self.data.clear()
+            self.sessions.clear()
@@ -0,0 +1,142 @@
+# CS472 - Homework #4
+# Edward Parrish
+# shaping.py
+#
+# This module is the traffic shaping module of the FTP server. It contains
+# the TokenBucket class and the Shaper class which the major module uses to
+# limit the rate of downloads and uploads, for all users together and for
+# each user.
+
+import threading
+import time
+
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+DIRECTIONS = (DOWNLOAD, UPLOAD)
+
+
+class TokenBucket:
+    '''TokenBucket
+    A thread safe token bucket of rate bytes per second holding at most burst
+    bytes. take() always succeeds but may leave the bucket in debt, and tells
+    the caller how long to wait for the debt to be paid, so transfers that
+    compete for a bucket are served in the order they asked. A rate of 0
+    means no limit. The rate can be changed while transfers use the bucket.'''
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+        self.tokens = self.burst
+
+    def set_rate(self, rate):
+        '''set_rate(rate)
+        Change the rate in bytes per second, 0 for no limit.'''
+
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = rate
+            self.burst = max(rate // 8, 64 * 1024)
+            self.tokens = min(self.tokens, self.burst)
+
+    def refill(self, now):
+        '''refill(now)
+        Add the tokens earned since the last update. The caller must hold the
+        lock.'''
+
+        if self.rate:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+
+        self.updated = now
+
+    def take(self, n):
+        '''take(n) -> seconds to wait before sending n bytes'''
+
+        with self.lock:
+            # Test if bucket has no limit.
+            if not self.rate:
+                return 0
+
+            self.refill(time.monotonic())
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0
+
+            return -self.tokens / self.rate
+
+
+class Limiter:
+    '''Limiter
+    The buckets that limit one direction of one user's transfers: the bucket
+    shared by all users and the user's own bucket.'''
+
+    def __init__(self, buckets, on_wait=None):
+        self.buckets = buckets
+        self.on_wait = on_wait
+
+    def limited(self):
+        '''limited() -> boolean
+        Test if any of the buckets currently has a limit.'''
+
+        return any(bucket.rate for bucket in self.buckets)
+
+    def throttle(self, n):
+        '''throttle(n)
+        Take n bytes from every bucket and wait until all of them allow it.'''
+
+        wait = max(bucket.take(n) for bucket in self.buckets)
+        if wait > 0:
+            if self.on_wait:
+                self.on_wait(wait)
+
+            time.sleep(wait)
+
+
+class Shaper:
+    '''Shaper
+    The token buckets of the server: one per direction shared by all users,
+    and one per direction for each user, shared by all of that user's
+    sessions. configure() changes the rates of every bucket at once, and the
+    transfers in flight keep running at the new rates.'''
+
+    def __init__(self, download=0, upload=0, user_download=0, user_upload=0,
+                 on_wait=None):
+        self.lock = threading.Lock()
+        self.on_wait = on_wait
+        self.rates = {}
+        self.shared = {d: TokenBucket() for d in DIRECTIONS}
+        self.users = {}
+        self.configure(download, upload, user_download, user_upload)
+
+    def configure(self, download=0, upload=0, user_download=0, user_upload=0):
+        '''configure(download=0, upload=0, user_download=0, user_upload=0)
+        Set the rates in bytes per second of all users together and of each
+        user, 0 for no limit.'''
+
+        with self.lock:
+            self.rates = {DOWNLOAD: user_download, UPLOAD: user_upload}
+            self.shared[DOWNLOAD].set_rate(download)
+            self.shared[UPLOAD].set_rate(upload)
+            for buckets in self.users.values():
+                for direction, bucket in buckets.items():
+                    bucket.set_rate(self.rates[direction])
+
+    def limiter(self, user, direction):
+        '''limiter(user, direction) -> Limiter
+        Return the limiter of a user's transfers in direction.'''
+
+        with self.lock:
+            buckets = self.users.get(user)
+            if not buckets:
+                buckets = self.users[user] = {
+                    d: TokenBucket(self.rates[d]) for d in DIRECTIONS}
+
+        on_wait = None
+        if self.on_wait:
+            on_wait = lambda wait: self.on_wait(direction, wait)
+
+        return Limiter([self.shared[direction], buckets[direction]], on_wait)
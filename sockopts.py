@@ -0,0 +1,91 @@
+# CS472 - Homework #4
+# Edward Parrish
+# sockopts.py
+#
+# This module is the socket options module of the FTP server. It contains the
+# SocketOptions class which the major module uses to tune the sockets of each
+# class of connection: control connections, and data connections made in
+# Active Mode or accepted in Passive Mode.
+
+import socket
+
+CONTROL = 'control'
+ACTIVE = 'active'
+PASSIVE = 'passive'
+
+
+class SocketOptions:
+    '''SocketOptions
+    The options of the sockets of one class of connection. nodelay turns off
+    Nagle's algorithm so small writes are sent at once instead of waiting for
+    the last one to be acknowledged. sndbuf and rcvbuf are the kernel buffer
+    sizes in bytes, 0 for the kernel's default, which on Linux also leaves the
+    buffers auto tuned. Buffers are set before a socket listens or connects so
+    the window scale agreed on in the handshake allows them.'''
+
+    def __init__(self, nodelay=False, sndbuf=0, rcvbuf=0):
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+
+    @staticmethod
+    def of(config, kind):
+        '''of(config, kind) -> SocketOptions
+        Return the options of connections of kind CONTROL, ACTIVE, or PASSIVE
+        in config.'''
+
+        return SocketOptions(getattr(config, f'{kind}_nodelay'),
+                             getattr(config, f'{kind}_sndbuf'),
+                             getattr(config, f'{kind}_rcvbuf'))
+
+    def listening(self, sock):
+        '''listening(sock)
+        Set the options of a socket before it is bound to listen. Its address
+        can be bound again at once while old connections on it are in
+        TIME_WAIT, and the sockets it accepts inherit its buffer sizes.'''
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.buffers(sock)
+
+    def connecting(self, sock):
+        '''connecting(sock)
+        Set the options of a socket before it connects.'''
+
+        self.buffers(sock)
+
+    def buffers(self, sock):
+        '''buffers(sock)
+        Set the buffer sizes of a socket that are not left to the kernel.'''
+
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def connected(self, sock):
+        '''connected(sock)
+        Set the options of a socket once it is connected. A socket the client
+        has already reset is left as it is.'''
+
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                            int(self.nodelay))
+        except OSError:
+            pass
+
+
+def cork(sock, corked):
+    '''cork(sock, corked)
+    Cork or uncork a data socket. While it is corked the kernel only sends
+    full segments, so data written in many pieces leaves in as few packets as
+    possible; uncorking sends what is left at once. Does nothing where there
+    is no TCP_CORK.'''
+
+    if not hasattr(socket, 'TCP_CORK'):
+        return
+
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(corked))
+    except OSError:
+        pass
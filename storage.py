@@ -0,0 +1,471 @@
+# CS472 - Homework #4
+# Edward Parrish
+# storage.py
+#
+# This module is the storage module of the FTP server. It contains the storage
+# backends the utility module's File class uses for all file system access:
+# LocalStorage for the local file system and MemoryStorage, which keeps every
+# file in memory so the protocol can be benchmarked without disk noise.
+#
+# A backend provides:
+#     home_dir(user)                -> path of the user's home, created if new
+#     realpath(base, path)          -> absolute path of path relative to base
+#     exists, isfile, isdir, isreadable, iswritable (path) -> boolean
+#     size(path)                    -> size in bytes of a file
+#     stat(path)                    -> stat result with the os.stat fields
+#     list_lines(path), name_lines(path) -> generators of listing lines
+#     open_read(path)               -> binary file object to read
+#     open_write(path, offset, append) -> binary file object to write
+#     sync(f)                       -> make a written file durable
+#     map(path), unmap(m)           -> read only buffer of a whole file, or
+#                                      None if it cannot be mapped
+#     zero_copy                     -> True if files opened to read may be
+#                                      sent with sendfile
+
+import itertools
+import mmap
+import os
+import posixpath
+import stat
+import threading
+import time
+from listing import Lister
+
+
+class LocalStorage:
+    '''LocalStorage
+    Stores files in the local file system. User home directories are kept in
+    the ./home directory.'''
+
+    zero_copy = hasattr(os, 'sendfile')
+
+    def __init__(self):
+        self.lister = Lister()
+
+    def home_dir(self, user):
+        '''home_dir(user) -> path to user's home directory
+        Get the user's home directory. If one does not already exist then create
+        it. If a file is in its place, append underscore(s) to filename and
+        create directory in its place.'''
+
+        CUR_DIR = os.path.abspath('.')
+        HOME = self.realpath(CUR_DIR, './home')
+
+        # Test if home dir does not exist.
+        if not os.path.exists(HOME):
+            os.mkdir(HOME)
+
+        # Get absolute path to user directory.
+        path = self.realpath(HOME, user)
+
+        # Test if does not path exist.
+        if not os.path.exists(path):
+            os.mkdir(path)
+
+        # Test if path is a file.
+        elif os.path.isfile(path):
+            new_name = path
+            file_renamed = False
+            while not file_renamed:
+                # Append underscore to new name.
+                new_name = f'{new_name}_'
+                try:
+                    # Rename file to new name and create user home dir.
+                    os.rename(path, new_name)
+                    os.mkdir(path)
+                    file_renamed = True
+
+                except OSError:
+                    pass
+
+        return path
+
+    def realpath(self, path1, path2):
+        '''realpath(path1, path2) -> file path
+        If path2 is an absolute path then return path2. Otherwise, join path1
+        and path2 and get the real path from result.'''
+
+        # Test if path2 is absolute path.
+        if (os.path.isabs(path2)):
+            return path2
+
+        join = os.path.join(path1, path2)
+        return os.path.realpath(join)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def isreadable(self, path):
+        return os.access(path, os.R_OK)
+
+    def iswritable(self, path):
+        return os.access(path, os.W_OK)
+
+    def size(self, path):
+        return os.path.getsize(path)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def list_lines(self, path):
+        return self.lister.list_lines(path)
+
+    def name_lines(self, path):
+        return self.lister.name_lines(path)
+
+    def open_read(self, path):
+        '''open_read(path) -> binary file object'''
+
+        return open(path, 'rb')
+
+    def open_write(self, path, offset=0, append=False):
+        '''open_write(path, offset=0, append=False) -> binary file object
+        Open a file to be written from offset, or from its end if append. The
+        file is emptied first if neither is given.'''
+
+        if append:
+            return open(path, 'ab')
+
+        if not offset:
+            return open(path, 'wb')
+
+        f = open(path, 'r+b')
+        f.seek(offset)
+        return f
+
+    def sync(self, f):
+        '''sync(f)
+        Write a file's buffered data and wait until it has reached the disk.'''
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    def map(self, path):
+        '''map(path) -> read only memory map of a file or None
+        Map a file into memory. Returns None if it cannot be mapped, such as
+        when it is empty.'''
+
+        try:
+            with open(path, 'rb') as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+    def unmap(self, m):
+        m.close()
+
+
+class MemoryNode:
+    '''MemoryNode
+    A file or directory of a MemoryStorage. A file's data is replaced, never
+    changed in place, once written, so it can be read without a lock.'''
+
+    def __init__(self, ino, is_dir):
+        self.ino = ino
+        self.children = set() if is_dir else None
+        self.data = None if is_dir else bytearray()
+        self.mtime_ns = time.time_ns()
+
+
+class MemoryStat:
+    '''MemoryStat
+    The stat result of a MemoryNode, with the fields of os.stat's result that
+    the server uses.'''
+
+    UID = os.getuid() if hasattr(os, 'getuid') else 0
+    GID = os.getgid() if hasattr(os, 'getgid') else 0
+
+    def __init__(self, node):
+        is_dir = node.children is not None
+        self.st_mode = stat.S_IFDIR | 0o755 if is_dir else stat.S_IFREG | 0o644
+        self.st_ino = node.ino
+        self.st_dev = 0
+        self.st_nlink = 2 if is_dir else 1
+        self.st_uid = MemoryStat.UID
+        self.st_gid = MemoryStat.GID
+        self.st_size = len(node.children) if is_dir else len(node.data)
+        self.st_mtime_ns = node.mtime_ns
+        self.st_mtime = node.mtime_ns / 1e9
+
+
+class MemoryReader:
+    '''MemoryReader
+    A binary file object reading the data of a MemoryNode.'''
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def seek(self, pos):
+        self.pos = pos
+        return pos
+
+    def readinto(self, b):
+        '''readinto(b) -> number of bytes read into b'''
+
+        chunk = self.view[self.pos:self.pos + len(b)]
+        n = len(chunk)
+        b[:n] = chunk
+        self.pos += n
+        return n
+
+    def close(self):
+        self.view.release()
+
+
+class MemoryWriter:
+    '''MemoryWriter
+    A binary file object writing a new copy of the data of a MemoryNode. The
+    data is stored in the node when the writer is closed.'''
+
+    def __init__(self, storage, node, data, pos):
+        self.storage = storage
+        self.node = node
+        self.data = data
+        self.pos = pos
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, b):
+        '''write(b) -> number of bytes written'''
+
+        n = len(b)
+        self.data[self.pos:self.pos + n] = b
+        self.pos += n
+        return n
+
+    def truncate(self):
+        '''truncate()
+        Cut the data off at the current position.'''
+
+        del self.data[self.pos:]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.storage.commit(self.node, self.data)
+
+
+class MemoryStorage:
+    '''MemoryStorage
+    Stores files and directories in memory, keyed by absolute POSIX path. User
+    home directories are kept in /home. All access is thread safe; a file that
+    is being read while it is rewritten is read as it was when opened.'''
+
+    zero_copy = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inos = itertools.count(1)
+        self.nodes = {'/': MemoryNode(next(self.inos), True)}
+        self.lister = Lister()
+
+    def node(self, path):
+        '''node(path) -> MemoryNode or None'''
+
+        return self.nodes.get(posixpath.normpath(path))
+
+    def add(self, path, is_dir):
+        '''add(path, is_dir) -> MemoryNode
+        Add a file or directory, or return the one already at path. Raises
+        FileNotFoundError if the parent directory does not exist. The caller
+        must hold the lock.'''
+
+        path = posixpath.normpath(path)
+        node = self.nodes.get(path)
+        if node:
+            return node
+
+        parent_path, name = posixpath.split(path)
+        parent = self.nodes.get(parent_path)
+
+        # Test if parent is not a directory.
+        if not parent or parent.children is None:
+            raise FileNotFoundError(path)
+
+        node = self.nodes[path] = MemoryNode(next(self.inos), is_dir)
+        parent.children.add(name)
+        parent.mtime_ns = time.time_ns()
+        return node
+
+    def makedirs(self, path):
+        '''makedirs(path)
+        Create a directory and any missing parent directories.'''
+
+        path = posixpath.normpath(path)
+        with self.lock:
+            parts = path.strip('/').split('/')
+            for i in range(len(parts)):
+                self.add('/' + '/'.join(parts[:i + 1]), True)
+
+    def commit(self, node, data):
+        '''commit(node, data)
+        Replace the data of a file.'''
+
+        with self.lock:
+            node.data = data
+            node.mtime_ns = time.time_ns()
+
+    def load(self, source, path='/'):
+        '''load(source, path='/')
+        Copy the local directory tree at source into the directory at path,
+        such as to give a benchmark its files.'''
+
+        for root, dirs, files in os.walk(source):
+            rel = os.path.relpath(root, source).replace(os.sep, '/')
+            base = posixpath.normpath(posixpath.join(path, rel))
+            self.makedirs(base)
+            for name in files:
+                with open(os.path.join(root, name), 'rb') as f:
+                    data = bytearray(f.read())
+
+                with self.lock:
+                    node = self.add(posixpath.join(base, name), False)
+
+                self.commit(node, data)
+
+    def home_dir(self, user):
+        '''home_dir(user) -> path to user's home directory
+        Get the user's home directory, creating it if it does not exist.'''
+
+        path = posixpath.join('/home', user)
+        self.makedirs(path)
+        return path
+
+    def realpath(self, path1, path2):
+        '''realpath(path1, path2) -> file path
+        Join path1 and path2, unless path2 is absolute, and normalize it.'''
+
+        return posixpath.normpath(posixpath.join(path1, path2))
+
+    def exists(self, path):
+        return self.node(path) is not None
+
+    def isfile(self, path):
+        node = self.node(path)
+        return node is not None and node.children is None
+
+    def isdir(self, path):
+        node = self.node(path)
+        return node is not None and node.children is not None
+
+    def isreadable(self, path):
+        return self.exists(path)
+
+    def iswritable(self, path):
+        return self.exists(path)
+
+    def size(self, path):
+        return self.stat(path).st_size
+
+    def stat(self, path):
+        node = self.node(path)
+
+        # Test if path does not exist.
+        if not node:
+            raise FileNotFoundError(path)
+
+        return MemoryStat(node)
+
+    def entries(self, path):
+        '''entries(path) -> list of (path, name, stat result)
+        Return the entries of the directory at path, or path itself if it is
+        a file.'''
+
+        path = posixpath.normpath(path)
+        with self.lock:
+            node = self.nodes.get(path)
+
+            # Test if path does not exist.
+            if not node:
+                raise FileNotFoundError(path)
+
+            # Test if path is a file.
+            if node.children is None:
+                return [(path, posixpath.basename(path), MemoryStat(node))]
+
+            result = []
+            for name in node.children:
+                child = posixpath.join(path, name)
+                result.append((child, name, MemoryStat(self.nodes[child])))
+
+            return result
+
+    def list_lines(self, path):
+        '''list_lines(path) -> generator of "ls -l" lines'''
+
+        now = time.time()
+        for child, name, st in self.entries(path):
+            yield self.lister.line(child, name, st, now)
+
+    def name_lines(self, path):
+        '''name_lines(path) -> generator of names'''
+
+        for child, name, st in self.entries(path):
+            yield name
+
+    def open_read(self, path):
+        '''open_read(path) -> binary file object'''
+
+        # Test if path is not a file.
+        if not self.isfile(path):
+            raise FileNotFoundError(path)
+
+        return MemoryReader(self.node(path).data)
+
+    def open_write(self, path, offset=0, append=False):
+        '''open_write(path, offset=0, append=False) -> binary file object
+        Open a file to be written from offset, or from its end if append. The
+        file is emptied first if neither is given.'''
+
+        with self.lock:
+            node = self.add(path, False)
+
+            # Test if path is a directory.
+            if node.children is not None:
+                raise IsADirectoryError(path)
+
+            # Test if the old data is kept.
+            if append or offset:
+                data = bytearray(node.data)
+            else:
+                node.data = bytearray()
+                data = bytearray()
+
+        pos = len(data) if append else offset
+        return MemoryWriter(self, node, data, pos)
+
+    def sync(self, f):
+        pass
+
+    def map(self, path):
+        '''map(path) -> data of a file or None
+        A file's data is never changed once written, so it is shared as is.'''
+
+        node = self.node(path)
+
+        # Test if path is not a file.
+        if not node or node.children is not None:
+            return None
+
+        return node.data
+
+    def unmap(self, m):
+        pass
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# CS472 - Homework #4
+# Edward Parrish
+# users.py
+#
+# This module is the users module of the FTP server. It contains the UserDB
+# class which reads the user file, and the Authenticator class which the
+# major module uses to check passwords against it. The user file has one
+# user per line:
+#
+#     username:password hash:home directory:rw or ro
+#
+# The home directory is relative to ./home and defaults to the username. A
+# password hash is made with:
+#
+#     python3 users.py PASSWORD
+
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import secrets
+import sys
+import threading
+import time
+
+# Parameters of new password hashes.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000
+SALT_BYTES = 16
+
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def hash_password(password):
+    '''hash_password(password) -> password hash
+    Hash a password with scrypt, or PBKDF2-SHA256 if this Python does not
+    have scrypt, and a random salt.'''
+
+    salt = secrets.token_bytes(SALT_BYTES)
+    if hasattr(hashlib, 'scrypt'):
+        key = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N,
+                             r=SCRYPT_R, p=SCRYPT_P)
+        return f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${b64(salt)}${b64(key)}'
+
+    key = hashlib.pbkdf2_hmac('sha256', password.encode(), salt,
+                              PBKDF2_ITERATIONS)
+    return f'pbkdf2_sha256${PBKDF2_ITERATIONS}${b64(salt)}${b64(key)}'
+
+
+def check_password(password, stored):
+    '''check_password(password, stored) -> boolean
+    Test if password matches a hash made by hash_password(). Returns False
+    if the hash is malformed.'''
+
+    try:
+        scheme, *fields = stored.split('$')
+        if scheme == 'scrypt':
+            n, r, p, salt, key = fields
+            key = base64.b64decode(key)
+            actual = hashlib.scrypt(
+                password.encode(), salt=base64.b64decode(salt), n=int(n),
+                r=int(r), p=int(p), maxmem=128 * int(n) * int(r) * 2,
+                dklen=len(key))
+
+        elif scheme == 'pbkdf2_sha256':
+            iterations, salt, key = fields
+            key = base64.b64decode(key)
+            actual = hashlib.pbkdf2_hmac(
+                'sha256', password.encode(), base64.b64decode(salt),
+                int(iterations), len(key))
+
+        else:
+            return False
+
+    except (ValueError, TypeError, AttributeError):
+        return False
+
+    return hmac.compare_digest(actual, key)
+
+
+class User:
+    '''User
+    An account of the user file.'''
+
+    def __init__(self, name, password_hash, home='', read_only=False):
+        self.name = name
+        self.password_hash = password_hash
+        self.home = home or name
+        self.read_only = read_only
+
+
+class UserDB:
+    '''UserDB
+    The users of the user file, reloaded when the file changes. The file is
+    checked at most once every CHECK_INTERVAL seconds. If there is no user
+    file the built in cs472 account is the only user.'''
+
+    CHECK_INTERVAL = 1.0
+    COMMENT = '#'
+    SEPARATOR = ':'
+    READ_ONLY = 'ro'
+
+    def __init__(self, path, log=None):
+        self.path = path
+        self.log = log or (lambda description: None)
+        self.lock = threading.Lock()
+        self.users = {}
+        self.validator = False
+        self.next_check = 0
+        self.reloads = 0
+        self.builtin = {'cs472': User('cs472', hash_password('hw2ftp'))}
+        self.check()
+
+    def get(self, name):
+        '''get(name) -> User or None'''
+
+        # Test if user file is due to be checked for changes.
+        if time.monotonic() >= self.next_check:
+            self.check()
+
+        return self.users.get(name)
+
+    def check(self):
+        '''check()
+        Reload the user file if it was created, changed, or removed since it
+        was last read.'''
+
+        with self.lock:
+            self.next_check = time.monotonic() + UserDB.CHECK_INTERVAL
+            try:
+                st = os.stat(self.path)
+                validator = (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns)
+            except OSError:
+                validator = None
+
+            # Test if user file is unchanged.
+            if validator == self.validator:
+                return
+
+            self.validator = validator
+            if validator is None:
+                self.users = self.builtin
+                self.log(f'No user file {self.path}; using built in account.')
+                return
+
+            try:
+                self.users = self.load()
+                self.reloads += 1
+                self.log(f'Loaded {len(self.users)} users from {self.path}.')
+            except OSError as err:
+                self.log(f'Error reading user file {self.path}: {err}')
+
+    def load(self):
+        '''load() -> dictionary of username to User
+        Read the user file. Malformed lines are skipped.'''
+
+        users = {}
+        with open(self.path, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+
+                # Test if line is blank or a comment.
+                if not line or line[0] == UserDB.COMMENT:
+                    continue
+
+                fields = line.split(UserDB.SEPARATOR)
+                if len(fields) < 2 or not fields[0] or not fields[1]:
+                    self.log(f'Skipping line {number} of {self.path}.')
+                    continue
+
+                fields += [''] * (4 - len(fields))
+                name, password_hash, home, access = fields[:4]
+                users[name] = User(name, password_hash, home.strip(),
+                                   access.strip().lower() == UserDB.READ_ONLY)
+
+        return users
+
+
+class FailureLimiter:
+    '''FailureLimiter
+    Counts failed logins per client address and blocks an address once it has
+    max_failures failures within the last window seconds. Addresses are kept
+    in the order they last failed, so those with no recent failures are
+    forgotten from the front as others fail, and at most MAX_ADDRESSES are
+    remembered.'''
+
+    MAX_ADDRESSES = 65536
+
+    def __init__(self, max_failures, window):
+        self.max_failures = max_failures
+        self.window = window
+        self.lock = threading.Lock()
+        self.failures = collections.OrderedDict()
+        self.blocked = 0
+
+    def allow(self, addr):
+        '''allow(addr) -> boolean
+        Test if a client address may try to log in.'''
+
+        with self.lock:
+            times = self.recent(addr)
+            if times and len(times) >= self.max_failures:
+                self.blocked += 1
+                return False
+
+            return True
+
+    def fail(self, addr):
+        '''fail(addr)
+        Count a failed login of a client address.'''
+
+        with self.lock:
+            times = self.recent(addr)
+            if times is None:
+                times = self.failures[addr] = collections.deque()
+            else:
+                self.failures.move_to_end(addr)
+
+            times.append(time.monotonic())
+            self.sweep()
+
+    def sweep(self):
+        '''sweep()
+        Forget the addresses that last failed before the window, and those
+        that failed least recently while there are more than MAX_ADDRESSES.
+        The caller must hold the lock.'''
+
+        cutoff = time.monotonic() - self.window
+        while self.failures:
+            addr, times = next(iter(self.failures.items()))
+
+            # Test if address failed recently and there is room for it.
+            if times[-1] >= cutoff and \
+                    len(self.failures) <= FailureLimiter.MAX_ADDRESSES:
+                break
+
+            del self.failures[addr]
+
+    def recent(self, addr):
+        '''recent(addr) -> deque of failure times or None
+        Drop the failures of addr that are older than the window. The caller
+        must hold the lock.'''
+
+        times = self.failures.get(addr)
+        cutoff = time.monotonic() - self.window
+        while times and times[0] < cutoff:
+            times.popleft()
+
+        # Test if address has no recent failures.
+        if times is not None and not times:
+            del self.failures[addr]
+            return None
+
+        return times
+
+    def counters(self):
+        with self.lock:
+            return {'addresses': len(self.failures), 'blocked': self.blocked}
+
+
+class Authenticator:
+    '''Authenticator
+    Checks passwords against a UserDB. Hashes are checked by a small thread
+    pool so a login storm uses at most that many cores, and recent successful
+    checks are remembered, keyed by a keyed hash of the user and password,
+    so returning users skip the slow hash.'''
+
+    # Checked for unknown users so they take as long as known ones.
+    DUMMY_HASH = hash_password(secrets.token_hex(8))
+
+    def __init__(self, db, workers=2, cache_size=1024, max_failures=5,
+                 window=60):
+        self.db = db
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='auth')
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.secret = secrets.token_bytes(32)
+        self.limiter = FailureLimiter(max_failures, window)
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, cache_size, max_failures, window):
+        '''configure(cache_size, max_failures, window)
+        Change the size of the cache and the limit of failed logins.'''
+
+        with self.lock:
+            self.cache_size = cache_size
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        self.limiter.max_failures = max_failures
+        self.limiter.window = window
+
+    def login(self, name, password, addr):
+        '''login(name, password, addr) -> (User or None, boolean)
+        Check a user's password. Returns the user if the password is correct,
+        and False as the second value if addr is blocked for failing too
+        often, in which case the password is not checked.'''
+
+        # Test if client address failed too often.
+        if not self.limiter.allow(addr):
+            return None, False
+
+        user = self.db.get(name)
+        if user and self.verify(user, password):
+            return user, True
+
+        # Unknown users are checked against a dummy hash.
+        if not user:
+            self.check(password, Authenticator.DUMMY_HASH)
+
+        self.limiter.fail(addr)
+        return None, True
+
+    def verify(self, user, password):
+        '''verify(user, password) -> boolean
+        Test if password is the user's password, using the cache of recent
+        successful checks.'''
+
+        key = hmac.digest(self.secret, f'{user.name}\0{password}'.encode(),
+                          'sha256')
+
+        with self.lock:
+            # Test if this password was checked against this hash recently.
+            if self.cache.get(key) == user.password_hash:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return True
+
+            self.misses += 1
+
+        if not self.check(password, user.password_hash):
+            return False
+
+        with self.lock:
+            self.cache[key] = user.password_hash
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return True
+
+    def check(self, password, stored):
+        '''check(password, stored) -> boolean
+        Check a password hash on the thread pool.'''
+
+        return self.executor.submit(check_password, password, stored).result()
+
+    def counters(self):
+        '''counters() -> dictionary of counter name to value'''
+
+        with self.lock:
+            c = {'cache_hits': self.hits, 'cache_misses': self.misses,
+                 'cache_entries': len(self.cache)}
+
+        c['users'] = len(self.db.users)
+        for name, value in self.limiter.counters().items():
+            c[f'failed_{name}'] = value
+
+        return c
+
+
+if __name__ == '__main__':
+    # Print the hash of a password for the user file.
+    if len(sys.argv) != 2:
+        sys.exit(f'Usage: {sys.argv[0]} PASSWORD')
+
+    print(hash_password(sys.argv[1]))
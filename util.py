@@ -7,10 +7,14 @@
 # functions for the major module.
 
 import sys
+import copy
 import os
 import stat
 import random
 import platform
+import threading
+from storage import LocalStorage
+from cache import PathCache
 
 
 class System:
@@ -46,6 +50,28 @@ class System:
 
         return (sys.argv[1], port)
 
+    @staticmethod
+    def workers():
+        '''workers() -> number of worker processes or None
+        Retrieve the number given by the --workers N command line option, or
+        None if the option is not given.'''
+
+        # Test if option is not given.
+        if '--workers' not in sys.argv:
+            return None
+
+        i = sys.argv.index('--workers')
+        try:
+            n = int(sys.argv[i + 1])
+        except (IndexError, ValueError):
+            n = 0
+
+        # Test if number of workers is not a positive integer.
+        if n < 1:
+            System.exit('--workers must be a positive integer')
+
+        return n
+
     @staticmethod
     def exit(msg, is_arg_err=False):
         '''exit(msg)
@@ -59,12 +85,8 @@ class System:
 
         exit('exiting...')
 
-    @staticmethod
-    def credentials_are_correct(user, pswd):
-        '''credentials_correct(user, pswd) -> boolean
-        Tests if the given username and password are correct login credentials.'''
-
-        return user == 'cs472' and pswd == 'hw2ftp'
+    # Path of the user file, read by the users module.
+    USERS_PATH = './home/elp49/ftpusers'
 
     DEFAULT_ENCODING = 'ISO-8859-1'
 
@@ -90,35 +112,47 @@ class System:
     def system_info():
         return f'{platform.system()} {platform.release()}'
 
+    # Path of the config file.
+    CONFIG_PATH = './home/elp49/ftpserverd.conf'
+
     @staticmethod
     def config():
-        '''config() -> configuration tuple
-        Read the config file at the hardcoded path "./home/elp49/ftpserver.conf"
-        and return the configuration settings.'''
+        '''config() -> Config
+        Read the config file at CONFIG_PATH and return the configuration
+        settings. Blank lines and comments are skipped.'''
 
         config = Config()
-        path = './home/elp49/ftpserverd.conf'
 
         try:
-            f = open(path, mode='r')
+            f = open(System.CONFIG_PATH, mode='r')
         except:
             return config
 
-        line = f.readline().strip()
-        while line:
-            if line[0] != Config.COMMENT:
-                a = line.split(Config.OPERATOR)
-                if len(a) > 1:
-                    attribute = a[0].strip()
-                    value = a[1].strip().split(Config.COMMENT)[0].strip()
-                    if attribute and value:
-                        config.set_attribute(attribute, value)
-
-            line = f.readline().strip()
+        with f:
+            for line in f:
+                line = line.strip()
+                if line and line[0] != Config.COMMENT:
+                    a = line.split(Config.OPERATOR, 1)
+                    if len(a) > 1:
+                        attribute = a[0].strip()
+                        value = a[1].strip().split(Config.COMMENT)[0].strip()
+                        if attribute and value:
+                            config.set_attribute(attribute, value)
 
-        f.close()
         return config
 
+    @staticmethod
+    def config_validator():
+        '''config_validator() -> (inode, size, modification time) of the
+        config file or None if it does not exist'''
+
+        try:
+            st = os.stat(System.CONFIG_PATH)
+        except OSError:
+            return None
+
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
 
 class Config:
 
@@ -126,31 +160,191 @@ class Config:
     OPERATOR = '='
     PORT_MODE = 'port_mode'
     PASV_MODE = 'pasv_mode'
-    ATTRIBUTES = [PORT_MODE, PASV_MODE]
+    FSYNC_ON_CLOSE = 'fsync_on_close'
+    ASYNC_MODE = 'async_mode'
+    LOG_COMPRESS = 'log_compress'
+    MEMORY_STORAGE = 'memory_storage'
+    BUFFER_SIZE = 'buffer_size'
+    ASYNC_WORKERS = 'async_workers'
+    MAX_SESSIONS = 'max_sessions'
+    WORKER_THREADS = 'worker_threads'
+    LISTEN_BACKLOG = 'listen_backlog'
+    LOG_FLUSH_LINES = 'log_flush_lines'
+    LOG_FLUSH_MS = 'log_flush_ms'
+    LOG_MAX_BYTES = 'log_max_bytes'
+    LOG_ROTATE_SECONDS = 'log_rotate_seconds'
+    LOG_BACKUPS = 'log_backups'
+    LISTING_CACHE_BYTES = 'listing_cache_bytes'
+    PATH_CACHE_MS = 'path_cache_ms'
+    PASV_MIN_PORT = 'pasv_min_port'
+    PASV_MAX_PORT = 'pasv_max_port'
+    DATA_ACCEPT_TIMEOUT = 'data_accept_timeout'
+    DATA_CONNECT_TIMEOUT = 'data_connect_timeout'
+    IDLE_TIMEOUT = 'idle_timeout'
+    DATA_STALL_TIMEOUT = 'data_stall_timeout'
+    REAPER_INTERVAL = 'reaper_interval'
+    DOWNLOAD_RATE = 'download_rate'
+    UPLOAD_RATE = 'upload_rate'
+    USER_DOWNLOAD_RATE = 'user_download_rate'
+    USER_UPLOAD_RATE = 'user_upload_rate'
+    LISTEN_PORT = 'listen_port'
+    LISTEN_ADDRESS = 'listen_address'
+    LOG_FILE = 'log_file'
+    MODE_Z_LEVEL = 'mode_z_level'
+    METRICS_PORT = 'metrics_port'
+    FILE_CACHE_BYTES = 'file_cache_bytes'
+    WORKERS = 'workers'
+    AUTH_WORKERS = 'auth_workers'
+    AUTH_CACHE_SIZE = 'auth_cache_size'
+    LOGIN_MAX_FAILURES = 'login_max_failures'
+    LOGIN_FAILURE_WINDOW = 'login_failure_window'
+    CONTROL_NODELAY = 'control_nodelay'
+    CONTROL_SNDBUF = 'control_sndbuf'
+    CONTROL_RCVBUF = 'control_rcvbuf'
+    ACTIVE_NODELAY = 'active_nodelay'
+    ACTIVE_SNDBUF = 'active_sndbuf'
+    ACTIVE_RCVBUF = 'active_rcvbuf'
+    PASSIVE_NODELAY = 'passive_nodelay'
+    PASSIVE_SNDBUF = 'passive_sndbuf'
+    PASSIVE_RCVBUF = 'passive_rcvbuf'
+    DATA_CORK = 'data_cork'
+    BOOL_ATTRIBUTES = [PORT_MODE, PASV_MODE, FSYNC_ON_CLOSE, ASYNC_MODE,
+                       LOG_COMPRESS, MEMORY_STORAGE, CONTROL_NODELAY,
+                       ACTIVE_NODELAY, PASSIVE_NODELAY, DATA_CORK]
+    INT_ATTRIBUTES = [BUFFER_SIZE, ASYNC_WORKERS, MAX_SESSIONS,
+                      WORKER_THREADS, LISTEN_BACKLOG, LOG_FLUSH_LINES,
+                      LOG_FLUSH_MS, LOG_MAX_BYTES, LOG_ROTATE_SECONDS,
+                      LOG_BACKUPS, LISTING_CACHE_BYTES, PASV_MIN_PORT,
+                      PASV_MAX_PORT, DATA_ACCEPT_TIMEOUT, DATA_CONNECT_TIMEOUT,
+                      MODE_Z_LEVEL, METRICS_PORT, FILE_CACHE_BYTES, WORKERS,
+                      AUTH_WORKERS, AUTH_CACHE_SIZE, LOGIN_MAX_FAILURES,
+                      LOGIN_FAILURE_WINDOW, PATH_CACHE_MS, IDLE_TIMEOUT,
+                      DATA_STALL_TIMEOUT, REAPER_INTERVAL, DOWNLOAD_RATE,
+                      UPLOAD_RATE, USER_DOWNLOAD_RATE, USER_UPLOAD_RATE,
+                      LISTEN_PORT, CONTROL_SNDBUF, CONTROL_RCVBUF,
+                      ACTIVE_SNDBUF, ACTIVE_RCVBUF, PASSIVE_SNDBUF,
+                      PASSIVE_RCVBUF]
+    # Integer attributes where 0 turns the feature off.
+    OPTIONAL_INT_ATTRIBUTES = [LOG_MAX_BYTES, LOG_ROTATE_SECONDS,
+                               LISTING_CACHE_BYTES, MODE_Z_LEVEL,
+                               METRICS_PORT, FILE_CACHE_BYTES,
+                               AUTH_CACHE_SIZE, PATH_CACHE_MS, IDLE_TIMEOUT,
+                               DATA_STALL_TIMEOUT, DOWNLOAD_RATE, UPLOAD_RATE,
+                               USER_DOWNLOAD_RATE, USER_UPLOAD_RATE,
+                               CONTROL_SNDBUF, CONTROL_RCVBUF, ACTIVE_SNDBUF,
+                               ACTIVE_RCVBUF, PASSIVE_SNDBUF, PASSIVE_RCVBUF]
+    STRING_ATTRIBUTES = [LISTEN_ADDRESS, LOG_FILE]
+    ATTRIBUTES = BOOL_ATTRIBUTES + INT_ATTRIBUTES + STRING_ATTRIBUTES
+
+    # Attributes that only take effect when the server is restarted.
+    RESTART_ATTRIBUTES = [ASYNC_MODE, MEMORY_STORAGE, ASYNC_WORKERS,
+                          WORKER_THREADS, LISTEN_BACKLOG, METRICS_PORT,
+                          WORKERS, AUTH_WORKERS, LISTEN_PORT, LISTEN_ADDRESS,
+                          LOG_FILE, CONTROL_SNDBUF, CONTROL_RCVBUF]
 
     YES = 'yes'
     NO = 'no'
     VALUES = [YES, NO]
 
+    DEFAULT_BUFFER_SIZE = 64 * 1024
+    DEFAULT_ASYNC_WORKERS = 32
+    DEFAULT_MAX_SESSIONS = 256
+    DEFAULT_WORKER_THREADS = 256
+    DEFAULT_LISTEN_BACKLOG = 128
+    DEFAULT_LOG_FLUSH_LINES = 256
+    DEFAULT_LOG_FLUSH_MS = 1000
+    DEFAULT_LOG_BACKUPS = 5
+    DEFAULT_LISTING_CACHE_BYTES = 16 * 1024 * 1024
+    DEFAULT_PATH_CACHE_MS = 1000
+    DEFAULT_PASV_MIN_PORT = 50000
+    DEFAULT_PASV_MAX_PORT = 60000
+    DEFAULT_DATA_ACCEPT_TIMEOUT = 60
+    DEFAULT_DATA_CONNECT_TIMEOUT = 30
+    DEFAULT_IDLE_TIMEOUT = 300
+    DEFAULT_DATA_STALL_TIMEOUT = 120
+    DEFAULT_REAPER_INTERVAL = 30
+    DEFAULT_MODE_Z_LEVEL = 6
+    DEFAULT_METRICS_PORT = 0
+    DEFAULT_FILE_CACHE_BYTES = 64 * 1024 * 1024
+    DEFAULT_WORKERS = 1
+    DEFAULT_LISTEN_PORT = 2121
+    DEFAULT_LISTEN_ADDRESS = ''
+    DEFAULT_LOG_FILE = 'mylog.txt'
+    DEFAULT_AUTH_WORKERS = 2
+    DEFAULT_AUTH_CACHE_SIZE = 1024
+    DEFAULT_LOGIN_MAX_FAILURES = 5
+    DEFAULT_LOGIN_FAILURE_WINDOW = 60
+
     def __init__(self, port_mode=True, pasv_mode=True):
         self.port_mode = port_mode
         self.pasv_mode = pasv_mode
+        self.fsync_on_close = False
+        self.async_mode = False
+        self.buffer_size = Config.DEFAULT_BUFFER_SIZE
+        self.async_workers = Config.DEFAULT_ASYNC_WORKERS
+        self.max_sessions = Config.DEFAULT_MAX_SESSIONS
+        self.worker_threads = Config.DEFAULT_WORKER_THREADS
+        self.listen_backlog = Config.DEFAULT_LISTEN_BACKLOG
+        self.log_flush_lines = Config.DEFAULT_LOG_FLUSH_LINES
+        self.log_flush_ms = Config.DEFAULT_LOG_FLUSH_MS
+        self.log_max_bytes = 0
+        self.log_rotate_seconds = 0
+        self.log_backups = Config.DEFAULT_LOG_BACKUPS
+        self.log_compress = False
+        self.memory_storage = False
+        self.listing_cache_bytes = Config.DEFAULT_LISTING_CACHE_BYTES
+        self.path_cache_ms = Config.DEFAULT_PATH_CACHE_MS
+        self.pasv_min_port = Config.DEFAULT_PASV_MIN_PORT
+        self.pasv_max_port = Config.DEFAULT_PASV_MAX_PORT
+        self.data_accept_timeout = Config.DEFAULT_DATA_ACCEPT_TIMEOUT
+        self.data_connect_timeout = Config.DEFAULT_DATA_CONNECT_TIMEOUT
+        self.idle_timeout = Config.DEFAULT_IDLE_TIMEOUT
+        self.data_stall_timeout = Config.DEFAULT_DATA_STALL_TIMEOUT
+        self.reaper_interval = Config.DEFAULT_REAPER_INTERVAL
+        self.download_rate = 0
+        self.upload_rate = 0
+        self.user_download_rate = 0
+        self.user_upload_rate = 0
+        self.listen_port = Config.DEFAULT_LISTEN_PORT
+        self.listen_address = Config.DEFAULT_LISTEN_ADDRESS
+        self.log_file = Config.DEFAULT_LOG_FILE
+        self.mode_z_level = Config.DEFAULT_MODE_Z_LEVEL
+        self.metrics_port = Config.DEFAULT_METRICS_PORT
+        self.file_cache_bytes = Config.DEFAULT_FILE_CACHE_BYTES
+        self.workers = Config.DEFAULT_WORKERS
+        self.auth_workers = Config.DEFAULT_AUTH_WORKERS
+        self.auth_cache_size = Config.DEFAULT_AUTH_CACHE_SIZE
+        self.login_max_failures = Config.DEFAULT_LOGIN_MAX_FAILURES
+        self.login_failure_window = Config.DEFAULT_LOGIN_FAILURE_WINDOW
+        self.control_nodelay = True
+        self.control_sndbuf = 0
+        self.control_rcvbuf = 0
+        self.active_nodelay = False
+        self.active_sndbuf = 0
+        self.active_rcvbuf = 0
+        self.passive_nodelay = False
+        self.passive_sndbuf = 0
+        self.passive_rcvbuf = 0
+        self.data_cork = True
 
     def set_attribute(self, attribute, value):
         a = attribute.lower()
         v = value.lower()
-        if a in Config.ATTRIBUTES and v in Config.VALUES:
-            if a == Config.PORT_MODE:
-                if v == Config.YES:
-                    self.port_mode = True
-                elif v == Config.NO:
-                    self.port_mode = False
-
-            elif a == Config.PASV_MODE:
-                if v == Config.YES:
-                    self.pasv_mode = True
-                elif v == Config.NO:
-                    self.pasv_mode = False
+        if a in Config.BOOL_ATTRIBUTES and v in Config.VALUES:
+            setattr(self, a, v == Config.YES)
+
+        elif a in Config.STRING_ATTRIBUTES:
+            setattr(self, a, value)
+
+        elif a in Config.INT_ATTRIBUTES:
+            # Test if value is not a positive integer.
+            try:
+                n = int(v)
+            except ValueError:
+                return
+
+            if n > 0 or (n == 0 and a in Config.OPTIONAL_INT_ATTRIBUTES):
+                setattr(self, a, n)
 
     def all_data_conn_types_disabled(self):
         '''all_data_conn_types_disabled() -> boolean
@@ -161,48 +355,168 @@ class Config:
 
         return True
 
+    def pasv_range_is_valid(self, port_min, port_max):
+        '''pasv_range_is_valid(port_min, port_max) -> boolean
+        Test if the passive port range is not empty and is within port_min and
+        port_max.'''
+
+        return port_min <= self.pasv_min_port <= self.pasv_max_port <= port_max
+
+    def error(self, port_min, port_max):
+        '''error(port_min, port_max) -> error message or None
+        Test if the settings can be used, with ports between port_min and
+        port_max.'''
+
+        if self.all_data_conn_types_disabled():
+            return 'server config file disables both PORT and PASV.'
+
+        if not self.pasv_range_is_valid(port_min, port_max):
+            return f'server config file passive port range must be within {port_min} - {port_max}.'
+
+        if not port_min <= self.listen_port <= port_max:
+            return f'server config file listen port must be within {port_min} - {port_max}.'
+
+        return None
+
+    def changes(self, other):
+        '''changes(other) -> list of the attributes whose values differ in
+        other'''
+
+        return [a for a in vars(self) if getattr(self, a) != getattr(other, a)]
+
+    def for_worker(self, index, workers):
+        '''for_worker(index, workers) -> Config
+        Return a copy of the config for worker process index of workers. Each
+        worker gets its own slice of the passive port range and a share of the
+        session limit, file cache budget, rates, and failed logins. Metrics
+        are served by the parent.'''
+
+        config = copy.copy(self)
+        config.workers = 1
+        config.metrics_port = 0
+
+        # Split the passive ports into one contiguous slice per worker.
+        ports = self.pasv_max_port - self.pasv_min_port + 1
+        config.pasv_min_port = self.pasv_min_port + ports * index // workers
+        config.pasv_max_port = \
+            self.pasv_min_port + ports * (index + 1) // workers - 1
+
+        config.max_sessions = max(1, -(-self.max_sessions // workers))
+        config.file_cache_bytes = self.file_cache_bytes // workers
+
+        # An upload only clears the cached listings of the worker it ran on,
+        # and overwriting a file does not change its directory's validator,
+        # so other workers would list the old size. Listings are not cached
+        # when there is more than one worker.
+        if workers > 1:
+            config.listing_cache_bytes = 0
+
+        # Rates are rounded up so a small limit does not become 0, which
+        # would mean no limit.
+        config.download_rate = -(-self.download_rate // workers)
+        config.upload_rate = -(-self.upload_rate // workers)
+        config.user_download_rate = -(-self.user_download_rate // workers)
+        config.user_upload_rate = -(-self.user_upload_rate // workers)
+
+        # Each worker counts the failed logins it sees, so an address is
+        # blocked after about login_max_failures over all workers.
+        config.login_max_failures = -(-self.login_max_failures // workers)
+        return config
+
+
+class ConfigWatcher:
+    '''ConfigWatcher
+    A thread that calls reload() when the config file changes, which it
+    checks for every CHECK_INTERVAL seconds, or when a reload is requested,
+    such as on SIGHUP.'''
+
+    CHECK_INTERVAL = 2
+
+    def __init__(self, reload):
+        self.reload = reload
+        self.requested = threading.Event()
+
+    def start(self):
+        '''start()
+        Start the watcher's thread.'''
+
+        t = threading.Thread(target=self.run, name='config', daemon=True)
+        t.start()
+
+    def request(self):
+        '''request()
+        Ask for the config file to be reloaded now. Safe to call from a
+        signal handler.'''
+
+        self.requested.set()
+
+    def run(self):
+        '''run()
+        The main loop of the watcher's thread.'''
+
+        validator = System.config_validator()
+        while True:
+            requested = self.requested.wait(ConfigWatcher.CHECK_INTERVAL)
+            self.requested.clear()
+
+            # Test if reload was requested or config file changed.
+            current = System.config_validator()
+            if requested or current != validator:
+                validator = current
+                self.reload()
+
 
 class File:
     '''File
-    This class provides the FTP server with common file system helper functions.'''
+    This class provides the FTP server with common file system helper functions.
+    All file system access goes through the storage backend in STORAGE, which
+    is the local file system unless the server is configured otherwise.
+    Resolved paths and the tests of paths are cached in PATHS, and each user's
+    home directory in HOMES once it has been created.'''
+
+    STORAGE = LocalStorage()
+    PATHS = PathCache(0)
+    HOMES = {}
+
+    # Tests of a path that are cached and must be forgotten when it changes.
+    TESTS = ('exists', 'isfile', 'isdir', 'isreadable', 'iswritable')
+
+    @staticmethod
+    def use_storage(storage):
+        '''use_storage(storage)
+        Set the storage backend used for all file system access.'''
+
+        File.STORAGE = storage
+        File.HOMES = {}
+
+    @staticmethod
+    def use_path_cache(cache):
+        '''use_path_cache(cache)
+        Set the PathCache of resolved paths and path tests.'''
+
+        File.PATHS = cache
+
+    @staticmethod
+    def forget(path):
+        '''forget(path)
+        Drop the cached tests of a path the server has changed.'''
+
+        File.PATHS.invalidate([(test, path) for test in File.TESTS])
 
     @staticmethod
     def get_home_dir(user):
         '''get_home_dir(user) -> path to user's home directory
-        Get the user's home directory. If one does not already exist then create
-        it. If a file is in its place, append underscore(s) to filename and
-        create directory in its place.'''
-
-        CUR_DIR = os.path.abspath('.')
-        HOME = File.realpath(CUR_DIR, './home')
-
-        # Test if home dir does not exist.
-        if not os.path.exists(HOME):
-            os.mkdir(HOME)
-
-        # Get absolute path to user directory.
-        path = File.realpath(HOME, user)
-
-        # Test if does not path exist.
-        if not os.path.exists(path):
-            os.mkdir(path)
-
-        # Test if path is a file.
-        elif os.path.isfile(path):
-            new_name = path
-            file_renamed = False
-            while not file_renamed:
-                # Append underscore to new name.
-                new_name = f'{new_name}_'
-                try:
-                    # Rename file to new name and create user home dir.
-                    os.rename(path, new_name)
-                    os.mkdir(path)
-                    file_renamed = True
-
-                except OSError:
-                    pass
+        Get the user's home directory, creating it if it does not exist. Once
+        created it is only looked for again if it stops being a directory.'''
+
+        path = File.HOMES.get(user)
+
+        # Test if home directory was already created and still exists.
+        if path and File.isdir(path):
+            return path
 
+        path = File.HOMES[user] = File.STORAGE.home_dir(user)
+        File.forget(path)
         return path
 
     @staticmethod
@@ -211,12 +525,9 @@ class File:
         If path2 is an absolute path then return path2. Otherwise, join path1
         and path2 and get the real path from result.'''
 
-        # Test if path2 is absolute path.
-        if (os.path.isabs(path2)):
-            return path2
-
-        join = os.path.join(path1, path2)
-        return os.path.realpath(join)
+        return File.PATHS.lookup(
+            ('realpath', path1, path2),
+            lambda: File.STORAGE.realpath(path1, path2))
 
     @staticmethod
     def parent(path):
@@ -229,35 +540,40 @@ class File:
         '''exists(path) -> boolean
         Determine if the path exists.'''
 
-        return os.path.exists(path)
+        return File.PATHS.lookup(
+            ('exists', path), lambda: File.STORAGE.exists(path))
 
     @staticmethod
     def isfile(path):
         '''isfile(path) -> boolean
         Determine if the path is a file.'''
 
-        return os.path.isfile(path)
+        return File.PATHS.lookup(
+            ('isfile', path), lambda: File.STORAGE.isfile(path))
 
     @staticmethod
     def isdir(path):
         '''isdir(path) -> boolean
         Determine if the path is a directory.'''
 
-        return os.path.isdir(path)
+        return File.PATHS.lookup(
+            ('isdir', path), lambda: File.STORAGE.isdir(path))
 
     @staticmethod
     def isreadable(path):
         '''isreadable(path) -> boolean
         Determine if the path is readable.'''
 
-        return os.access(path, os.R_OK)
+        return File.PATHS.lookup(
+            ('isreadable', path), lambda: File.STORAGE.isreadable(path))
 
     @staticmethod
     def iswritable(path):
         '''iswritable(path) -> boolean
         Determine if the path is writable.'''
 
-        return os.access(path, os.W_OK)
+        return File.PATHS.lookup(
+            ('iswritable', path), lambda: File.STORAGE.iswritable(path))
 
     @staticmethod
     def can_write_file(path):
@@ -269,18 +585,69 @@ class File:
 
     @staticmethod
     def listdir(path):
-        # Open pipe to acces command line stream.
-        stream = os.popen(f'ls -Al {path}')
+        '''listdir(path) -> generator of "ls -l" lines
+        List the entries at path. Lines are produced while the directory is
+        being read.'''
 
-        # Read command lines output.
-        listing = stream.readlines()
+        return File.STORAGE.list_lines(path)
 
-        # Remove line breaks.
-        for i in range(len(listing)):
-            listing[i] = listing[i].rstrip()
+    @staticmethod
+    def namelist(path):
+        '''namelist(path) -> generator of names
+        List the names of the entries at path.'''
 
-        return '\n'.join(listing)
+        return File.STORAGE.name_lines(path)
 
     @staticmethod
     def get_file_size(path):
-        return os.path.getsize(path)
+        return File.STORAGE.size(path)
+
+    @staticmethod
+    def stat(path):
+        '''stat(path) -> stat result
+        Get the status of the path. Raises OSError if it does not exist.'''
+
+        return File.STORAGE.stat(path)
+
+    @staticmethod
+    def open_read(path):
+        '''open_read(path) -> binary file object
+        Open a file to be read.'''
+
+        return File.STORAGE.open_read(path)
+
+    @staticmethod
+    def open_write(path, offset=0, append=False):
+        '''open_write(path, offset=0, append=False) -> binary file object
+        Open a file to be written from offset, or from its end if append. The
+        file is emptied first if neither is given.'''
+
+        return File.STORAGE.open_write(path, offset, append)
+
+    @staticmethod
+    def sync(f):
+        '''sync(f)
+        Make the data written to a file durable.'''
+
+        File.STORAGE.sync(f)
+
+    @staticmethod
+    def map(path):
+        '''map(path) -> read only buffer of a whole file or None
+        Map a file into memory. Returns None if it cannot be mapped.'''
+
+        return File.STORAGE.map(path)
+
+    @staticmethod
+    def unmap(m):
+        '''unmap(m)
+        Release a buffer returned by map().'''
+
+        File.STORAGE.unmap(m)
+
+    @staticmethod
+    def zero_copy():
+        '''zero_copy() -> boolean
+        Determine if files opened to read can be sent with sendfile.'''
+
+        return File.STORAGE.zero_copy